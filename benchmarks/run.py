@@ -0,0 +1,462 @@
+"""Times the extension's hot paths against an in-memory CKAN (see stubs.py)
+
+    python benchmarks/run.py                       # run everything, save results
+    python benchmarks/run.py -k dqs                # only benchmarks with "dqs" in their name
+    python benchmarks/run.py --compare latest      # compare with the last saved run
+    python benchmarks/run.py --compare benchmarks/results/<file>.json --threshold 20
+
+Each run is saved to benchmarks/results/ as json, named after the time and
+git commit it ran at. With --compare, each benchmark's median is compared to
+the other run's, and the script exits with an error if any got slower by
+more than --threshold percent.
+
+Sizes are what we see in production: 5k facet values, 200-resource packages,
+a 30k-row ETL catalog.
+"""
+
+import argparse
+import copy
+import glob
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import stubs  # noqa: E402
+
+stubs.install(
+    {
+        "ckan.site_id": "benchmark",
+        "ckanext.opendata.export_dir": tempfile.gettempdir(),
+    }
+)
+
+from ckanext.opendata import api, cache, export, plugin, schema, utils  # noqa: E402
+
+RESULTS_DIR = os.path.join(HERE, "results")
+
+TOPICS = [
+    "Business", "City government", "Community services", "Culture and tourism",
+    "Development and infrastructure", "Environment", "Finance", "Health",
+    "Locations and mapping", "Parks and recreation", "Permits and licenses",
+    "Public safety", "Transportation", "Water", "Waste",
+]
+
+FORMATS = ["CSV", "JSON", "XML", "GEOJSON", "SHP", "GPKG", "XLSX", "ZIP", "PDF"]
+
+DQS_CODES = (
+    "colnames_unclear~constant_cols:ward,year,status~metadata_missing:"
+    "information_url,excerpt~owner_is_opendata~missing_def_cols:a,b,c,d~stale~"
+    "significant_missing_data~no_pipeline_found~no_tags~periods_behind:3.5~"
+    "refresh_rate:monthly~filestore_resource"
+)
+
+
+# ==============================
+# fixtures
+# ==============================
+
+
+def make_package(resource_count=200, name="benchmark-package"):
+    start = datetime(2020, 1, 1)
+    resources = []
+    for i in range(resource_count):
+        resources.append(
+            {
+                "id": "resource-{:04d}".format(i),
+                "package_id": "package-id",
+                "name": "resource {}".format(i),
+                "format": random.choice(FORMATS),
+                "url": "https://example.com/resource-{}.csv".format(i),
+                "datastore_active": i % 2 == 0,
+                "state": "active",
+                "created": start + timedelta(days=i),
+                "last_modified": start + timedelta(days=i, hours=random.randint(0, 23)),
+            }
+        )
+    return {
+        "id": "package-id",
+        "name": name,
+        "owner_division": "Information & Technology",
+        "refresh_rate": "Monthly",
+        "dataset_category": "Table",
+        "resources": resources,
+    }
+
+
+def make_facet_items(count=5000):
+    # solr hands "multiple_" attributes back as strings of lists
+    items = []
+    for i in range(count):
+        names = random.sample(TOPICS, random.randint(1, 4))
+        items.append(
+            {
+                "name": "{" + ",".join('"{}"'.format(n) for n in names) + "}",
+                "display_name": ",".join(names),
+                "count": random.randint(1, 50),
+            }
+        )
+    return items
+
+
+def make_catalog(rows=30000):
+    return {
+        "records": [
+            {
+                "_id": i,
+                "package_name": "package-{}".format(i // 3),
+                "resource_name": "resource-{}".format(i),
+                "etl_type": random.choice(["nifi", "airflow", "manual"]),
+                "schedule": random.choice(["daily", "weekly", "monthly"]),
+                "last_run": "2023-01-{:02d}T00:00:00".format(1 + i % 28),
+                "status": random.choice(["success", "failed"]),
+                "owner": "owner-{}".format(i % 40),
+            }
+            for i in range(rows)
+        ],
+        "fields": [],
+    }
+
+
+def make_dqs_records(package):
+    records = []
+    for resource in package["resources"]:
+        for days_ago in range(3):
+            records.append(
+                {
+                    "package": package["name"],
+                    "resource": resource["name"],
+                    "recorded_at": "2023-02-{:02d}T10:00:00".format(10 - days_ago),
+                    "store_type": "datastore" if resource["datastore_active"] else "filestore",
+                    "grade": random.choice(["Gold", "Silver", "Bronze"]),
+                    "score": random.random(),
+                    "freshness": random.random(),
+                    "metadata": random.random(),
+                    "accessibility": random.random(),
+                    "completeness": random.random(),
+                    "usability": random.random(),
+                    "freshness_code": DQS_CODES,
+                    "metadata_code": DQS_CODES,
+                    "accessibility_code": DQS_CODES,
+                    "completeness_code": DQS_CODES,
+                    "usability_code": DQS_CODES,
+                }
+            )
+    return records
+
+
+# ==============================
+# benchmarks
+# ==============================
+# each returns a function to time, after setting up the fakes it needs
+
+
+def bench_build_query_wildcards():
+    stubs.REDIS.flushall()
+    api.tk.config["ckanext.opendata.ngram_search"] = "false"
+    query = {
+        "{}[]".format(field): " ".join(random.sample(TOPICS, 3)).split(" ")[:5]
+        for field in ["vocab_topics", "vocab_civic_issues", "formats",
+                      "owner_division", "dataset_category", "refresh_rate"]
+    }
+    query["search"] = "bike share ridership by station and month 2023"
+    return lambda: api.build_query(query)
+
+
+def bench_build_query_ngrams():
+    run = bench_build_query_wildcards()
+    api.tk.config["ckanext.opendata.ngram_search"] = "true"
+    return run
+
+
+def bench_unstringify_5k():
+    items = make_facet_items(5000)
+    return lambda: utils.unstringify(items)
+
+
+def bench_parse_dqs_codes():
+    return lambda: utils.parse_dqs_codes(DQS_CODES)
+
+
+def bench_get_dqs_200_resources():
+    stubs.REDIS.flushall()
+    package = make_package(200)
+    records = make_dqs_records(package)
+    stubs.ACTIONS["quality_show"] = lambda context, data_dict: records
+
+    # the first call builds the index, the rest read it
+    utils.dqs_entry(package["name"], package["resources"][0]["name"])
+
+    def run():
+        for resource in package["resources"]:
+            utils.get_dqs(package, resource)
+
+    return run
+
+
+def bench_update_package_200_resources():
+    stubs.REDIS.flushall()
+    stubs.DB["resources"] = make_package(200)["resources"]
+    package = types.SimpleNamespace(
+        id="package-id", name="package", type="dataset", extras={}, metadata_modified=None
+    )
+
+    def run():
+        # start from stale extras, so they get written every time
+        package.extras = {"formats": "CSV", "last_refreshed": None}
+        schema.update_package({"package": package})
+
+    return run
+
+
+def bench_before_create_200_resources():
+    package = make_package(200)
+    stubs.ACTIONS["package_show"] = lambda context, data_dict: package
+    resource_plugin = plugin.UpdateSchemaPlugin()
+
+    def run():
+        resource_plugin.before_create(
+            {},
+            {
+                "package_id": "package-id",
+                "name": "a brand new resource",
+                "url": "https://example.com/new.csv",
+            },
+        )
+
+    return run
+
+
+def bench_get_catalog_cold_30k():
+    stubs.REDIS.flushall()
+    catalog = make_catalog(30000)
+    catalog_package = {
+        "id": "catalog-id",
+        "name": utils.CATALOG_PACKAGE,
+        "resources": [{"id": "catalog-resource", "url": "https://example.com/catalog"}],
+    }
+    stubs.ACTIONS["package_show"] = lambda context, data_dict: catalog_package
+    stubs.ACTIONS["datastore_search"] = lambda context, data_dict: copy.copy(catalog)
+
+    def run():
+        cache.invalidate("catalog")
+        utils.get_catalog()
+
+    return run
+
+
+def bench_get_catalog_warm_30k():
+    run = bench_get_catalog_cold_30k()
+    run()
+    return utils.get_catalog
+
+
+def bench_datastore_cache_200_resources():
+    """The whole datastore_cache orchestration for one resource of a
+    200-resource package: content state, conversions, one bulk upsert"""
+
+    stubs.REDIS.flushall()
+    package = make_package(200)
+    stubs.DB["resources"] = package["resources"]
+    resources = {r["id"]: r for r in package["resources"]}
+    resource_id = package["resources"][0]["id"]
+    output_dir = tempfile.mkdtemp(prefix="opendata-benchmark-")
+
+    def to_file(context, data_dict):
+        directory = tempfile.mkdtemp(dir=output_dir)
+        output = {}
+        for target_format in data_dict["target_formats"]:
+            path = os.path.join(directory, "{}.{}".format(resource_id, target_format))
+            with open(path, "w") as f:
+                f.write("_id,value\n" + "".join("{},{}\n".format(i, i) for i in range(1000)))
+            output[target_format] = path
+        return output
+
+    def prune(context, data_dict):
+        if os.path.isdir(data_dict["path"]):
+            shutil.rmtree(data_dict["path"], ignore_errors=True)
+        elif os.path.exists(data_dict["path"]):
+            os.remove(data_dict["path"])
+
+    def package_update(context, data_dict):
+        # like the real one, leave the package's model object in the context
+        context["package"] = types.SimpleNamespace(
+            id=package["id"], name=package["name"], type="dataset", extras={},
+            metadata_modified=None,
+        )
+        package["resources"] = data_dict["resources"]
+        resources.clear()
+        resources.update({r["id"]: r for r in package["resources"]})
+
+    stubs.ACTIONS.update(
+        {
+            "package_show": lambda context, data_dict: copy.deepcopy(package),
+            "resource_show": lambda context, data_dict: resources[data_dict["id"]],
+            "datastore_info": lambda context, data_dict: {
+                "schema": {"_id": "int", "value": "text"}
+            },
+            "resource_view_list": lambda context, data_dict: [
+                {"view_type": v} for v in ["dqs_view", "recline_view", "recline_map_view"]
+            ],
+            "to_file": to_file,
+            "prune": prune,
+            "package_update": package_update,
+            "resource_bulk_upsert": api.resource_bulk_upsert,
+        }
+    )
+
+    # the content state comes from a postgres query we cant fake
+    utils.datastore_content_state = lambda resource_id, up_to_id=None: {
+        "rows": 1000, "max_id": 1000, "rows_hash": "123456789", "columns": "abc",
+    }
+
+    # and so do the records the non spatial files are streamed from
+    export.table_columns = lambda resource_id: ["_id", "value"]
+    export.iter_records = lambda resource_id, columns=None, after_id=None: (
+        {"_id": i, "value": str(i)} for i in range(1000)
+    )
+
+    def run():
+        api.datastore_cache(
+            {"user": "benchmark", "auth_user_obj": object()},
+            {"resource_id": resource_id, "force": True, "workers": 4},
+        )
+
+    return run
+
+
+BENCHMARKS = [
+    ("build_query_wildcards", bench_build_query_wildcards, 2000),
+    ("build_query_ngrams", bench_build_query_ngrams, 2000),
+    ("unstringify_5k", bench_unstringify_5k, 20),
+    ("parse_dqs_codes", bench_parse_dqs_codes, 2000),
+    ("get_dqs_200_resources", bench_get_dqs_200_resources, 5),
+    ("update_package_200_resources", bench_update_package_200_resources, 200),
+    ("before_create_200_resources", bench_before_create_200_resources, 500),
+    ("get_catalog_cold_30k", bench_get_catalog_cold_30k, 3),
+    ("get_catalog_warm_30k", bench_get_catalog_warm_30k, 2000),
+    ("datastore_cache_200_resources", bench_datastore_cache_200_resources, 5),
+]
+
+
+# ==============================
+# running, saving and comparing
+# ==============================
+
+
+def time_benchmark(setup, number, repeat):
+    """Returns per-call timings in milliseconds: the median, min and max of
+    repeat samples, each the average of number calls"""
+
+    # fixtures are random, but seeded, so every run does the same work
+    random.seed(42)
+    run = setup()
+    run()  # warm up
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        samples.append((time.perf_counter() - start) / number * 1000)
+
+    return {
+        "median_ms": statistics.median(samples),
+        "min_ms": min(samples),
+        "max_ms": max(samples),
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE, stderr=subprocess.DEVNULL,
+        ).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save(run):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(
+        RESULTS_DIR, "{}-{}.json".format(run["started"].replace(":", ""), run["commit"])
+    )
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2, sort_keys=True)
+    return path
+
+
+def load(path):
+    if path == "latest":
+        paths = sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")))
+        if not paths:
+            return None
+        path = paths[-1]
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-k", dest="keyword", help="only run benchmarks with this in their name")
+    parser.add_argument("--repeat", type=int, default=5, help="samples per benchmark")
+    parser.add_argument("--compare", help="a saved run to compare with, or 'latest'")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent slowdown that counts as a regression")
+    parser.add_argument("--no-save", action="store_true", help="dont save this run")
+    args = parser.parse_args()
+
+    # load the comparison first, so "latest" isnt this run
+    previous = load(args.compare) if args.compare else None
+
+    run = {
+        "started": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "results": {},
+    }
+
+    regressions = []
+    for name, setup, number in BENCHMARKS:
+        if args.keyword and args.keyword not in name:
+            continue
+
+        result = time_benchmark(setup, number, args.repeat)
+        run["results"][name] = result
+
+        line = "{:<32} {:>12.4f} ms".format(name, result["median_ms"])
+        before = (previous or {}).get("results", {}).get(name)
+        if before:
+            change = (result["median_ms"] - before["median_ms"]) / before["median_ms"] * 100
+            line += "   {:+7.1f}% vs {}".format(change, previous["commit"])
+            if change > args.threshold:
+                regressions.append(name)
+                line += "   REGRESSION"
+        print(line)
+
+    if not args.no_save:
+        print("\nSaved to " + save(run))
+
+    if regressions:
+        print("\nSlower by more than {}%: {}".format(args.threshold, ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""In-memory stand-ins for CKAN, so the extension can be benchmarked without a
+CKAN site, postgres, solr or redis
+
+install() puts fake ckan modules in sys.modules before the extension is
+imported. Actions are plain functions in ACTIONS, which each benchmark fills
+with fakes - tk.get_action looks them up there, like CKAN's action registry.
+Third party libraries the extension imports (sqlalchemy, rq, werkzeug, flask,
+click) are only faked if they arent installed.
+"""
+
+import sys
+import types
+
+# fake action registry, by action name
+ACTIONS = {}
+
+# fake database rows the fake model reads, see FakeQuery
+DB = {"resources": []}
+
+
+class ValidationError(Exception):
+    pass
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class FakeRedis(object):
+    """Just enough of redis-py for the extension, kept in a dict"""
+
+    def __init__(self):
+        self.data = {}
+
+    @staticmethod
+    def _bytes(value):
+        return value if isinstance(value, bytes) else str(value).encode("utf-8")
+
+    def flushall(self):
+        self.data.clear()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = self._bytes(value)
+        return True
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def incr(self, key):
+        value = int(self.data.get(key, 0)) + 1
+        self.data[key] = self._bytes(value)
+        return value
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(self._bytes(field))
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[self._bytes(field)] = self._bytes(value)
+        return 1
+
+    def hmget(self, key, fields):
+        return [self.hget(key, field) for field in fields]
+
+    def hsetnx(self, key, field, value):
+        if self._bytes(field) in self.data.get(key, {}):
+            return 0
+        return self.hset(key, field, value)
+
+    def hdel(self, key, *fields):
+        return sum(
+            1
+            for field in fields
+            if self.data.get(key, {}).pop(self._bytes(field), None) is not None
+        )
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hincrby(self, key, field, amount=1):
+        value = int(self.hget(key, field) or 0) + amount
+        self.hset(key, field, value)
+        return value
+
+    def hincrbyfloat(self, key, field, amount=1.0):
+        value = float(self.hget(key, field) or 0) + amount
+        self.hset(key, field, repr(value))
+        return value
+
+    def sadd(self, key, *values):
+        items = self.data.setdefault(key, set())
+        before = len(items)
+        items.update(self._bytes(value) for value in values)
+        return len(items) - before
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def lpush(self, key, *values):
+        items = self.data.setdefault(key, [])
+        for value in values:
+            items.insert(0, self._bytes(value))
+        return len(items)
+
+    def ltrim(self, key, start, end):
+        if key in self.data:
+            self.data[key] = self.data[key][start:end + 1 if end != -1 else None]
+        return True
+
+    def lrange(self, key, start, end):
+        return self.data.get(key, [])[start:end + 1 if end != -1 else None]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        output = [
+            getattr(self.redis_conn, name)(*args, **kwargs)
+            for name, args, kwargs in self.calls
+        ]
+        self.calls = []
+        return output
+
+
+REDIS = FakeRedis()
+
+
+class FakeQuery(object):
+    """Answers the aggregate query in schema.update_package from DB"""
+
+    def __init__(self, *columns):
+        self.columns = columns
+
+    def filter(self, *args):
+        return self
+
+    def one(self):
+        resources = [r for r in DB["resources"] if r.get("state", "active") == "active"]
+        formats = list({r["format"].upper() for r in resources if r.get("format")})
+        dates = [r.get("last_modified") or r.get("created") for r in resources]
+        dates = [d for d in dates if d is not None]
+        return formats, max(dates) if dates else None
+
+
+class FakeSession(object):
+    def query(self, *columns):
+        return FakeQuery(*columns)
+
+    def remove(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def execute(self, *args, **kwargs):
+        return []
+
+
+class FakeUpload(object):
+    def __init__(self, resource):
+        upload = resource.pop("upload", None)
+        if upload is not None:
+            resource["url_type"] = "upload"
+            resource["url"] = upload.filename
+        self.upload_file = upload
+
+    def upload(self, resource_id, max_size=None):
+        # read the file, like the real uploader copies it
+        if self.upload_file is not None:
+            while self.upload_file.stream.read(1024 * 1024):
+                pass
+
+
+def plugin_validate(package_plugin, context, data_dict, schema, action):
+    # like the site's package schema, which saves our fields as extras
+    from ckanext.opendata import utils
+
+    validators = {
+        "formats": utils.choices_to_string,
+        "last_refreshed": utils.default_to_today,
+    }
+    extras = [
+        {"key": key, "value": validator(data_dict[key])}
+        for key, validator in validators.items()
+        if key in data_dict
+    ]
+    return {"extras": extras}, {}
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def _identity_decorator(function):
+    return function
+
+
+def get_action(name):
+    def action(context=None, data_dict=None):
+        return ACTIONS[name](context if context is not None else {}, data_dict or {})
+
+    return action
+
+
+def _placeholder(name):
+    # any plugin interface, e.g. p.IActions
+    return type(name, (object,), {})
+
+
+class _FakeFunc(object):
+    # sqlalchemy.func - any sql function, which the fake session ignores
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+def _is_installed(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+
+def install(config=None):
+    """Puts the fake ckan modules in place - call before importing ckanext.opendata"""
+
+    toolkit = _module(
+        "ckan.plugins.toolkit",
+        config=dict(config or {}),
+        asint=int,
+        asbool=lambda value: str(value).lower() in ["true", "1", "yes", "on"],
+        aslist=lambda value: value.split() if isinstance(value, str) else list(value),
+        side_effect_free=_identity_decorator,
+        chained_action=_identity_decorator,
+        get_action=get_action,
+        check_access=lambda *args, **kwargs: True,
+        enqueue_job=lambda *args, **kwargs: types.SimpleNamespace(id="job"),
+        add_template_directory=lambda *args: None,
+        ValidationError=ValidationError,
+        ObjectNotFound=ObjectNotFound,
+        c=types.SimpleNamespace(user="benchmark"),
+        _=lambda text: text,
+    )
+
+    plugins = _module(
+        "ckan.plugins",
+        toolkit=toolkit,
+        SingletonPlugin=object,
+        implements=lambda *args, **kwargs: None,
+    )
+    plugins.__getattr__ = _placeholder
+
+    _module("ckan")
+    _module("ckan.logic", ValidationError=ValidationError)
+    _module("ckan.lib")
+    _module(
+        "ckan.lib.jobs",
+        DEFAULT_QUEUE_NAME="default",
+        get_queue=lambda name=None: types.SimpleNamespace(fetch_job=lambda job_id: None),
+    )
+    _module(
+        "ckan.lib.uploader",
+        get_resource_uploader=FakeUpload,
+        get_max_resource_size=lambda: 10 * 1024 ** 3,
+    )
+    _module(
+        "ckan.lib.search",
+        index_for=lambda model: None,
+        commit=lambda: None,
+    )
+    _module("ckan.lib.redis", connect_to_redis=lambda: REDIS)
+    _module(
+        "ckan.lib.plugins",
+        lookup_package_plugin=lambda package_type=None: types.SimpleNamespace(
+            update_package_schema=lambda: {}
+        ),
+        plugin_validate=plugin_validate,
+    )
+    for name in ["jobs", "uploader", "search", "plugins", "redis"]:
+        setattr(sys.modules["ckan.lib"], name, sys.modules["ckan.lib." + name])
+
+    model_columns = types.SimpleNamespace(
+        id="id", name="name", state="state", format="format",
+        package_id="package_id", last_modified="last_modified",
+        created="created", metadata_modified="metadata_modified",
+        owner_org="owner_org", get=lambda id: None,
+    )
+    _module(
+        "ckan.model",
+        Session=FakeSession(),
+        repo=types.SimpleNamespace(commit=lambda: None),
+        Package=model_columns,
+        Resource=model_columns,
+        Group=types.SimpleNamespace(get=lambda name: None),
+        User=types.SimpleNamespace(get=lambda name: None),
+    )
+    sys.modules["ckan"].model = sys.modules["ckan.model"]
+    sys.modules["ckan"].plugins = plugins
+    sys.modules["ckan"].lib = sys.modules["ckan.lib"]
+    sys.modules["ckan"].logic = sys.modules["ckan.logic"]
+
+    _module("ckanext.datastore")
+    _module("ckanext.datastore.backend")
+    _module(
+        "ckanext.datastore.backend.postgres",
+        get_read_engine=lambda: None,
+        identifier=lambda name: '"{}"'.format(name.replace('"', '""')),
+    )
+
+    if not _is_installed("sqlalchemy"):
+        _module("sqlalchemy", func=_FakeFunc(), distinct=lambda value: value, text=str)
+
+    if not _is_installed("rq"):
+        _module("rq", get_current_job=lambda: None)
+        _module("rq.registry", StartedJobRegistry=None)
+
+    if not _is_installed("werkzeug"):
+        _module("werkzeug")
+        _module(
+            "werkzeug.datastructures",
+            FileStorage=lambda stream=None, filename=None: types.SimpleNamespace(
+                stream=stream, filename=filename
+            ),
+        )
+
+    if not _is_installed("werkzeug.http"):
+        _module(
+            "werkzeug.http",
+            is_resource_modified=lambda *args, **kwargs: True,
+            dump_options_header=lambda header, options: "; ".join(
+                [header] + ['{}="{}"'.format(k, v) for k, v in options.items()]
+            ),
+        )
+
+    if not _is_installed("flask"):
+        class Blueprint(object):
+            def __init__(self, name, import_name):
+                self.name = name
+
+            def route(self, rule, **options):
+                return _identity_decorator
+
+        _module(
+            "flask",
+            Blueprint=Blueprint,
+            Response=object,
+            request=None,
+            send_file=None,
+            stream_with_context=_identity_decorator,
+        )
+
+    if not _is_installed("click"):
+        def decorator_factory(*args, **kwargs):
+            def decorator(function):
+                function.command = decorator_factory
+                return function
+
+            return decorator
+
+        _module("click", group=decorator_factory, command=decorator_factory,
+                option=decorator_factory, echo=print)
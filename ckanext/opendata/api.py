@@ -1,15 +1,26 @@
 """'Logic for multiple Open Data Toronto-specific CKAN actions"""
 
 from ckan.logic import ValidationError
+from ckan.lib import jobs, uploader
+from ckan.lib.redis import connect_to_redis
+import ckan.model as model
 import ckan.plugins.toolkit as tk
+from rq import get_current_job
+import sqlalchemy as sa
 from werkzeug.datastructures import FileStorage
 
-from . import utils
+from . import backfill, cache, export, loads, metrics, reindex, schema, status, utils
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 import os
+import functools
 import io
+import json
 import logging
+import shutil
+import tempfile
+import uuid
 
 
 def build_query(query):
@@ -26,6 +37,16 @@ def build_query(query):
     """
     q = []
 
+    # with n-gram fields indexed, we can skip slow leading wildcard queries
+    ngram_fields = utils.ngram_fields() if utils.ngram_search_enabled() else []
+    ngram_max_length = utils.ngram_max_length()
+
+    def contains(field, term):
+        # returns the field and value to query for field containing term
+        if field in ngram_fields and 0 < len(term) <= ngram_max_length:
+            return utils.NGRAM_FIELD_PREFIX + field, utils.solr_phrase(term)
+        return field, "*{}*".format(term)
+
     for k, v in query.items():  # For items in the input API call's params...
         if not len(v):  # ignore empty strings and non-strings
             continue
@@ -46,7 +67,7 @@ def build_query(query):
                 "("
                 + " AND ".join(
                     [
-                        "+{f}:*{x}*".format(x=term.replace("vocab_", ""), f=f)
+                        "+{0}:{1}".format(*contains(f, term.replace("vocab_", "")))
                         for term in v
                     ]
                 )
@@ -61,10 +82,15 @@ def build_query(query):
                 " "
             ):  # split the input by spaces, add solr syntax, add to output
                 q.append(
-                    "(name:(*{0}*))^5.0 OR "
-                    "(tags:(*{1}*))^5.0 OR "
-                    '(notes:("{1}")) OR '
-                    "(title:(*{1}*))^10.0".format(w.replace(" ", "-"), w)
+                    "({0[0]}:({0[1]}))^5.0 OR "
+                    "({1[0]}:({1[1]}))^5.0 OR "
+                    '(notes:("{2}")) OR '
+                    "({3[0]}:({3[1]}))^10.0".format(
+                        contains("name", w.replace(" ", "-")),
+                        contains("tags", w),
+                        w,
+                        contains("title", w),
+                    )
                 )
 
     return q
@@ -80,22 +106,85 @@ def quality_show(context, data_dict):
     if pid is None:
         raise ValidationError("Missing package ID")
 
+    rid = _dqs_resource_id(context)
+
+    if rid is not None:
+        return [r for r in tk.get_action("datastore_search")(
+            context,
+            {"resource_id": rid, "q": {"package": pid},
+                "sort": "recorded_at desc"},
+        )["records"] if r["package"] == pid]
+
+
+def _dqs_resource_id(context):
+    """Returns the id of the resource DQS scores are loaded into"""
+    rid = None
+
     package = tk.get_action("package_show")(context, {
-        "id": "catalogue-quality-scores"
+        "id": utils.DQS_PACKAGE
         }
     )
 
     for r in package["resources"]:
-        if r["name"] == "quality-scores-explanation-codes-and-scores":
+        if r["name"] == utils.DQS_RESOURCE:
             rid = r["id"]
             break
 
+    # remember which resource scores come from, so loads into it can
+    # update the DQS index
     if rid is not None:
-        return [r for r in tk.get_action("datastore_search")(
-            context,
-            {"resource_id": rid, "q": {"package": pid},
-                "sort": "recorded_at desc"},
-        )["records"] if r["package"] == pid]
+        connect_to_redis().set(utils.redis_key("dqs", "resource_id"), rid)
+
+    return rid
+
+
+@tk.side_effect_free
+def quality_show_bulk(context, data_dict):
+    """Receives a list of package_ids (or "all") as input
+    returns the latest data quality scores of each of their resources
+
+    Results come a page at a time, sorted by package and resource. Pass the
+    "next_offset" of one page as the "offset" of the next call to get the
+    next page - it's None on the last page
+    """
+    package_ids = data_dict.get("package_ids")
+
+    if not package_ids:
+        raise ValidationError("Missing package IDs")
+
+    # accept a list, a comma separated string, or "all"
+    if isinstance(package_ids, str):
+        package_ids = None if package_ids == "all" else package_ids.split(",")
+    elif "all" in package_ids:
+        package_ids = None
+
+    max_limit = tk.asint(tk.config.get("ckanext.opendata.quality_show_bulk_limit", 10000))
+    try:
+        limit = min(tk.asint(data_dict.get("limit", max_limit)), max_limit)
+        offset = tk.asint(data_dict.get("offset", 0))
+    except (TypeError, ValueError):
+        raise ValidationError({"constraints": ["limit and offset should be integers"]})
+    if limit < 1 or offset < 0:
+        raise ValidationError(
+            {"constraints": ["limit should be at least 1, and offset at least 0"]}
+        )
+
+    rid = _dqs_resource_id(context)
+    if rid is None:
+        return {"records": [], "limit": limit, "offset": offset, "next_offset": None}
+
+    # scores are read straight from the datastore table, so check what
+    # datastore_search would in quality_show
+    tk.check_access("datastore_search", context, {"resource_id": rid})
+
+    records = utils.latest_dqs_records(rid, package_ids, limit, offset)
+
+    return {
+        "records": records,
+        "limit": limit,
+        "offset": offset,
+        "next_offset": offset + len(records) if len(records) == limit else None,
+    }
 
 
 @tk.side_effect_free
@@ -107,26 +196,28 @@ def query_facet(context, data_dict):
     """
 
     q = build_query(data_dict)
+    facet_fields = utils.to_list(data_dict["facet_field[]"])
 
-    output = tk.get_action("package_search")(
-        context,
-        {
-            "q": " AND ".join(["({x})".format(x=x) for x in q]),  # solr query
-            "rows": 0,  # max number of rows shown - presumably 0 is maximum
-            "facet": "on",  # whether to enable faceted results
-            "facet.limit": -1,  # vals a facet field can return. -1 = infinity
-            "facet.field": utils.to_list(
-                data_dict["facet_field[]"]
-            ),  # fields to facet on - usually a list of all dataset filters
-        },
-    )
-
-    # for the "multiple_" metadata attrs in the package schema, clean output
-    for facet in "topics", "civic_issues", "formats":
-        output["search_facets"][facet]["items"] = utils.unstringify(
-            output["search_facets"][facet]["items"]
+    def search():
+        output = tk.get_action("package_search")(
+            context,
+            {
+                "q": " AND ".join(["({x})".format(x=x) for x in q]),  # solr query
+                "rows": 0,  # max number of rows shown - presumably 0 is maximum
+                "facet": "on",  # whether to enable faceted results
+                "facet.limit": -1,  # vals a facet field can return. -1 = infinity
+                "facet.field": facet_fields,  # fields to facet on - usually a list of all dataset filters
+            },
         )
-    return output
+
+        # for the "multiple_" metadata attrs in the package schema, clean output
+        for facet in "topics", "civic_issues", "formats":
+            output["search_facets"][facet]["items"] = utils.unstringify(
+                output["search_facets"][facet]["items"]
+            )
+        return output
+
+    return _cached_search("search_facet", [sorted(q), sorted(facet_fields)], search)
 
 
 @tk.side_effect_free
@@ -139,21 +230,111 @@ def query_packages(context, data_dict):
     params = {"rows": 10, "sort": "score desc", "start": 0}
     params.update(data_dict)
 
-    output = tk.get_action("package_search")(
-        context,
-        {
-            "q": " AND ".join(["({x})".format(x=x) for x in q]),  # solr query
-            "rows": params["rows"],
-            "sort": params["sort"],  # this is solr specific
-            "start": params[
-                "start"
-            ],  # since its 0: start the returned dataset at the first record
-        },
+    def search():
+        return tk.get_action("package_search")(
+            context,
+            {
+                "q": " AND ".join(["({x})".format(x=x) for x in q]),  # solr query
+                "rows": params["rows"],
+                "sort": params["sort"],  # this is solr specific
+                "start": params[
+                    "start"
+                ],  # since its 0: start the returned dataset at the first record
+            },
+        )
+
+    return _cached_search(
+        "search_packages",
+        [sorted(q), str(params["rows"]), str(params["start"]), params["sort"]],
+        search,
     )
 
+
+# search results, by action and normalized query, for this process
+_search_caches = {}
+
+
+def _cached_search(name, key_parts, search):
+    """Returns a cached search result, or runs search() and caches its result
+
+    key_parts should be normalized, so the same filters clicked in a
+    different order make the same key. Once a change to any package is
+    committed, the "search" generation is bumped, which retires every
+    cached result (see package_changed)
+    """
+
+    if name not in _search_caches:
+        _search_caches[name] = cache.LRUCache(
+            tk.asint(tk.config.get("ckanext.opendata.search_cache_size", 1000)),
+            tk.asint(tk.config.get("ckanext.opendata.search_cache_ttl", 60)),
+        )
+
+    cache_key = json.dumps([cache.generation("search")] + key_parts)
+
+    output = _search_caches[name].get(cache_key)
+    if output is None:
+        output = search()
+        _search_caches[name].set(cache_key, output)
     return output
 
 
+def invalidate_search_cache():
+    # retires cached search results in every CKAN process
+    cache.bump_generation("search")
+
+
+# session.info key of the names of packages changed in a transaction
+CHANGED_PACKAGES = "opendata_changed_packages"
+
+
+def package_changed(package_name):
+    """Remembers that a package changed in the current transaction
+
+    Cached searches and metadata-catalog lookups are retired once the
+    transaction commits, not now - CKAN tells us of changes before it
+    commits them and reindexes the package, so a search run in between
+    would cache the old results again
+    """
+    model.Session.info.setdefault(CHANGED_PACKAGES, set()).add(package_name)
+
+
+def _after_commit(session):
+    # solr has the changed packages by now, see package_changed
+    changed = session.info.pop(CHANGED_PACKAGES, None)
+    if not changed:
+        return
+
+    invalidate_search_cache()
+    for package_name in changed:
+        utils.invalidate_protected_lookups(package_name)
+
+
+def _after_rollback(session):
+    # nothing was changed after all
+    session.info.pop(CHANGED_PACKAGES, None)
+
+
+def listen_for_commits():
+    # calls _after_commit and _after_rollback as CKAN's transactions end
+    if not sa.event.contains(model.Session, "after_commit", _after_commit):
+        sa.event.listen(model.Session, "after_commit", _after_commit)
+        sa.event.listen(model.Session, "after_rollback", _after_rollback)
+
+
+@tk.side_effect_free
+def search_cache_stats(context, data_dict):
+    """Returns hit / miss counts of the search_packages and search_facet
+    result caches in the CKAN process that answers this call"""
+
+    tk.check_access("sysadmin", context, data_dict)
+
+    return {
+        "pid": os.getpid(),
+        "generation": cache.generation("search"),
+        "caches": {name: c.stats() for name, c in _search_caches.items()},
+    }
+
+
 @tk.side_effect_free
 def datastore_cache(context, data_dict):
     """Logic for creating datastore_cache filestore resources
@@ -177,6 +358,17 @@ def datastore_cache(context, data_dict):
     It creates each of these in 2 EPSGs:
     - 4326
     - 2952
+
+    Resources whose datastore content hasnt changed since their last cache
+    are skipped, unless the "force" input is true
+
+    Each run's stages are timed, and the report is saved on the datastore
+    resource as "datastore_cache_report", next to datastore_cache_last_update
+
+    If records were only appended to a non geographic resource since its
+    last cache, the new records are added to the end of the existing CSV and
+    JSON files instead of rebuilding them. Set the "incremental" input to
+    false to always rebuild
     """
     # init some params we'll need later
     output = {}
@@ -198,8 +390,8 @@ def datastore_cache(context, data_dict):
     # if input param has package id, get all its datastore resource
     logging.info("[ckanext-opendatatoronto] --- Looking for package id in data_dict")
     if "package_id" in data_dict.keys():
-        package = tk.get_action("package_show")(
-            context, {"id": data_dict["package_id"]}
+        package = cache.cached_action(
+            context, "package_show", {"id": data_dict["package_id"]}
         )
         package_summary = {
             "package_id": package["name"],
@@ -213,12 +405,11 @@ def datastore_cache(context, data_dict):
     # otherwise, use input param has resource id only
     logging.info("[ckanext-opendatatoronto]----------- Looking for resource id in data_dict")
     if "resource_id" in data_dict.keys() and "package_id" not in data_dict.keys():
-        resource = tk.get_action("resource_show")(
-            context, {"id": data_dict["resource_id"]}
+        resource = cache.cached_action(
+            context, "resource_show", {"id": data_dict["resource_id"]}
         )
-        package = tk.get_action("package_show")(context, {
-            "id": resource["package_id"]
-            }
+        package = cache.cached_action(
+            context, "package_show", {"id": resource["package_id"]}
         )
         resource_id = (
             resource["id"]
@@ -237,6 +428,9 @@ def datastore_cache(context, data_dict):
         )
         package_summary = {"package_id": package["name"], "resources": [resource_dict]}
 
+    # drop non datastore resources we may have picked up
+    package_summary["resources"] = [r for r in package_summary["resources"] if r]
+
     logging.info(
         "----------- found {} resources in datastore_cache input".format(
             str(len(package_summary["resources"]))
@@ -248,188 +442,574 @@ def datastore_cache(context, data_dict):
             {"constraints": ["Your inputs are not associated with datastore resources"]}
         )
 
+    # conversions for one resource can run side by side - this is how many
+    # to_file calls we allow at once
+    workers = max(
+        1,
+        tk.asint(
+            data_dict.get(
+                "workers",
+                tk.config.get("ckanext.opendata.datastore_cache_workers", 4),
+            )
+        ),
+    )
+
+    force = tk.asbool(data_dict.get("force", False))
+    incremental = tk.asbool(data_dict.get("incremental", True)) and not force
+    resources = {r["id"]: r for r in package["resources"]}
+
     # for each resource id in your list...
+    current_job = get_current_job()
     for resource_info in package_summary["resources"]:
-        # init output
-        output = {}
+        report = metrics.RunReport(
+            on_stage=functools.partial(status.set_stage, resource_info["id"])
+        )
+        status.started(resource_info["id"], current_job.id if current_job else None)
+        try:
+            output = _datastore_cache_resource(
+                context,
+                package,
+                resource_info,
+                resources.get(resource_info["id"], {}),
+                workers,
+                force,
+                incremental,
+                report,
+            )
+        except Exception as e:
+            status.failed(resource_info["id"], str(e), report.summary())
+            raise
+        status.finished(resource_info["id"], report.summary())
 
-        # find out if resource is spatial
-        # if it is, we need to create 2 files per file format for each CRS
-        logging.info("[ckanext-opendatatoronto]--------- checking if spatial")
-        is_geospatial = utils.is_geospatial(resource_info["id"])
+    logging.info("[ckanext-opendatatoronto] --- Finished Datastore Cache")
+    return output
 
-        # create df of gdf for
-        # df = downloads._prepare_df(resource_info["id"], is_geospatial)
 
-        # run iotrans wrapper on (g)df for each file + EPSG combination
-        # if this is spatial, we'll need to repeat the stuff below for
-        # EPSG codes 4326 and 2952 in spatial formats
-        if is_geospatial:
-            target_formats = ["csv", "shp", "gpkg", "geojson"]
-            for format in target_formats:
-                output[format.upper()] = {}
+def _datastore_cache_resource(
+    context, package, resource_info, resource, workers, force, incremental, report
+):
+    """Builds the cached files of one datastore resource, for datastore_cache
+    Returns the resource's datastore_cache, as it is on the package now"""
+
+    # skip resources whose data hasnt changed since we last cached them -
+    # first with a cheap check, then by hashing every row if we must
+    previous_state = utils.to_dict(resource.get("datastore_cache_state"))
+    if not force and resource.get("datastore_cache"):
+        with report.stage("quick_state"):
+            unchanged = utils.datastore_unchanged_since(
+                resource_info["id"],
+                previous_state,
+                utils.datastore_cache_started(resource),
+            )
+        if unchanged:
+            logging.info(
+                "[ckanext-opendatatoronto]--------- {} unchanged since last cache, skipping".format(
+                    resource_info["id"]
+                )
+            )
+            report.details["rows"] = previous_state["rows"]
+            report.details["mode"] = "unchanged"
+            return resource["datastore_cache"]
 
-            logging.info("[ckanext-opendatatoronto]=========================== CONVERTING Spatial FILE")
-            logging.info(resource_info)
+    with report.stage("content_state") as span:
+        state = utils.datastore_content_state(
+            resource_info["id"], previous_state["max_id"] if previous_state else None
+        )
+        span["rows"] = state["rows"]
+    fingerprint = utils.datastore_fingerprint(state)
+    report.details["rows"] = state["rows"]
+    if (
+        not force
+        and resource.get("datastore_cache")
+        and resource.get("datastore_cache_fingerprint") == fingerprint
+    ):
+        logging.info(
+            "[ckanext-opendatatoronto]--------- {} unchanged since last cache, skipping".format(
+                resource_info["id"]
+            )
+        )
+        report.details["mode"] = "unchanged"
+        return resource["datastore_cache"]
+
+    # if records were only added to the end of the table, add them to
+    # the end of the cached files too
+    work_dir = tempfile.mkdtemp(dir=export.export_dir())
+    cache_files = None
+    try:
+        if incremental and resource.get("datastore_cache") and utils.is_append_only(
+            previous_state, state
+        ):
+            cache_files = _append_to_cache(
+                context, package, resource, previous_state, work_dir, report
+            )
+            report.details["mode"] = "incremental"
+
+        if cache_files is None:
+            cache_files = _cache_resource(
+                context, resource_info, workers, work_dir, report
+            )
+            report.details["mode"] = "full"
 
-            cached_files = tk.get_action("to_file")(
+        report.details["files"] = [
+            {
+                "format": cache_file["format"].upper(),
+                "epsg_code": cache_file["epsg_code"],
+                "bytes": os.path.getsize(cache_file["path"]),
+            }
+            for cache_file in cache_files
+        ]
+
+        # put the cached files, the ids of their resources, the current
+        # date and the report of this run (up to here) on the package,
+        # all at once
+        datastore_resource_patch = {
+            "datastore_cache_last_update": datetime.now().strftime(
+                "%Y-%m-%dT%H:%M:%S.%f"
+            ),
+            "datastore_cache_fingerprint": fingerprint,
+            "datastore_cache_state": {
+                k: v
+                for k, v in state.items()
+                if k in ["rows", "max_id", "rows_hash", "columns"]
+            },
+            "datastore_cache_report": report.summary(),
+        }
+        with report.stage(
+            "save_files", bytes=sum(f["bytes"] for f in report.details["files"])
+        ):
+            return _save_cache_files(
                 context,
+                package,
+                resource_info["id"],
+                cache_files,
+                datastore_resource_patch,
+            )
+    finally:
+        # delete temp files now that we've used them
+        with report.stage("prune"):
+            for cache_file in cache_files or []:
+                if not cache_file["path"].startswith(work_dir):
+                    tk.get_action("prune")(context, {"path": cache_file["path"]})
+                    tk.get_action("prune")(
+                        context, {"path": os.path.dirname(cache_file["path"])}
+                    )
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        logging.info(
+            "[ckanext-opendatatoronto] --- Datastore Cache report for {}: {}".format(
+                resource_info["id"], json.dumps(report.summary())
+            )
+        )
+
+
+def _cache_resource(context, resource_info, workers, work_dir, report):
+    """Converts one datastore resource into its cached files
+
+    Non spatial files are streamed straight out of the datastore into
+    work_dir. Spatial files need GDAL, so they're made by to_file
+    Returns a list of the files, each as a dict with its format, epsg code
+    (None for non spatial files) and path
+    """
+
+    # find out if resource is spatial
+    # if it is, we need to create 2 files per file format for each CRS
+    logging.info("[ckanext-opendatatoronto]--------- checking if spatial")
+    with report.stage("is_geospatial"):
+        is_geospatial = utils.is_geospatial(resource_info["id"], context)
+
+    # if this is spatial, we'll need to make files for EPSG codes
+    # 4326 and 2952 in spatial formats
+    # if its not spatial, we'll have different file formats,
+    # but no epsg codes to worry about
+    if is_geospatial:
+        logging.info("[ckanext-opendatatoronto]=========================== CONVERTING Spatial FILE")
+        target_formats = ["csv", "shp", "gpkg", "geojson"]
+        conversion_params = {"source_epsg": 4326, "target_epsgs": [4326, 2952]}
+    else:
+        logging.info("[ckanext-opendatatoronto]---------- CONVERTING Non Spatial FILE")
+        logging.info(resource_info)
+        return _export_files(
+            resource_info, ["csv", "xml", "json"], workers, work_dir, report
+        )
+    logging.info(resource_info)
+
+    cache_files = []
+    for cached_files in _convert_to_files(
+        context, resource_info["id"], target_formats, conversion_params, workers, report
+    ):
+        for key, val in cached_files.items():
+            cache_files.append(
                 {
-                    "resource_id": resource_info["id"],
-                    "source_epsg": 4326,
-                    "target_epsgs": [4326, 2952],
-                    "target_formats": target_formats,
-                },
+                    "format": key.split("-")[0],
+                    "epsg_code": key.split("-")[1] if is_geospatial else None,
+                    "path": val,
+                }
             )
 
-            # get directory where all these cached files will be stored
-            # we'll want to use it to delete the dir later
-            cached_files_dir = "/".join(list(cached_files.values())[0].split("/")[:-1])
-
-            for key, val in cached_files.items():
-                format = key.split("-")[0]
-                epsg_code = key.split("-")[1]
-                mimetype = "application/octet-stream"
-                filename = val.split("/")[-1]
-
-                #with open(val, "rb") as f:
-                #    response = io.BytesIO(f.read())
-                #    f.close()
-                #    logging.info("[ckanext-opendatatoronto]--------------- " + format + " " + epsg_code)
-                
-                f = open(val, "rb")
-                try:
-                    # try making a resource from scratch                    
-                    filestore_resource = tk.get_action("resource_create")(
-                        context,
-                        {
-                            "package_id": package_summary["package_id"],
-                            "mimetype": mimetype,
-                            "upload": FileStorage(stream=f, filename=filename),
-                            "name": filename,
-                            "format": format,
-                            "is_datastore_cache_file": True,
-                            "datastore_resource_id": resource_info["id"],
-                        },
-                    )
-                except Exception as e:                    
-                    
-                    # otherwise, update the existing one
-                    existing_resource = tk.get_action("resource_search")(
-                        context, {"query": "name:{}".format(filename)}
-                    )
-                    resource_id = existing_resource["results"][0]["id"]
-                    filestore_resource = tk.get_action("resource_patch")(
-                        context,
-                        {
-                            "id": resource_id,
-                            "mimetype": mimetype,
-                            "upload": FileStorage(stream=f, filename=filename),
-                            "name": filename,
-                            "format": format,
-                            "is_datastore_cache_file": True,
-                            "datastore_resource_id": resource_info["id"],
-                        },
-                    )
+    return cache_files
 
-                # add details to output
-                output[format.upper()][epsg_code] = filestore_resource["id"]
 
-                # delete temp file now that we've used it
-                tk.get_action("prune")(context, {"path": val})
+def _convert_to_files(context, resource_id, target_formats, conversion_params, workers, report):
+    """Yields to_file outputs as they finish, timing each to_file call
 
-        # if its not spatial, we'll have different file formats,
-        # but no epsg codes to worry about
-        elif not is_geospatial:
-            target_formats = ["csv", "xml", "json"]
-            for format in target_formats:
-                output[format.upper()] = {}
+    With one worker, all formats are converted by a single to_file call.
+    Otherwise each format gets its own to_file call on a thread pool, so the
+    whole conversion takes about as long as the slowest format.
+    Threads (not processes) are used because to_file is a CKAN action, and
+    needs this process' database session - the heavy lifting it does in
+    GDAL / pandas releases the GIL
+    """
 
-            logging.info("[ckanext-opendatatoronto]---------- CONVERTING Non Spatial FILE")
-            logging.info("[ckanext-opendatatoronto]-------------- " + format)
-            cached_files = tk.get_action("to_file")(
+    if workers == 1 or len(target_formats) == 1:
+        with report.stage("to_file", formats=target_formats) as span:
+            output = tk.get_action("to_file")(
                 context,
-                {
-                    "resource_id": resource_info["id"],
-                    "target_formats": target_formats,
-                },
+                dict(conversion_params, resource_id=resource_id, target_formats=target_formats),
             )
+            span["bytes"] = _files_size(output)
+        yield output
+        return
+
+    def convert(format):
+        # each thread gets its own context, and its own db session
+        thread_context = {
+            k: v for k, v in context.items() if k in ["user", "auth_user_obj", "ignore_auth"]
+        }
+        try:
+            with report.stage("to_file", formats=[format]) as span:
+                output = tk.get_action("to_file")(
+                    thread_context,
+                    dict(conversion_params, resource_id=resource_id, target_formats=[format]),
+                )
+                span["bytes"] = _files_size(output)
+            return output
+        finally:
+            model.Session.remove()
 
-            # get directory where all these cached files will be stored
-            # we'll want to use it to delete the dir later
-            cached_files_dir = "/".join(list(cached_files.values())[0].split("/")[:-1])
+    with ThreadPoolExecutor(max_workers=min(workers, len(target_formats))) as executor:
+        futures = [executor.submit(convert, format) for format in target_formats]
+        for future in as_completed(futures):
+            yield future.result()
 
-            for key, val in cached_files.items():
-                format = key.split("-")[0]
-                mimetype = "application/octet-stream"
-                filename = val.split("/")[-1]
-                #with open(val, "rb") as f:
-                #    response = io.BytesIO(f.read())
-                #    f.close()
 
-                f = open(val, "rb")
+def _export_files(resource_info, target_formats, workers, work_dir, report):
+    """Streams a non spatial datastore resource into a file per format
 
-                try:
-                    # try creating a resource
-                    filestore_resource = tk.get_action("resource_create")(
-                        context,
-                        {
-                            "package_id": package_summary["package_id"],
-                            "mimetype": mimetype,
-                            "upload": FileStorage(stream=f, filename=filename),
-                            "name": filename,
-                            "format": format,
-                            "is_datastore_cache_file": True,
-                            "datastore_resource_id": resource_info["id"],
-                        },
-                    )
-                except Exception:
-                    # otherwise edit an existing resource
-                    existing_resource = tk.get_action("resource_search")(
-                        context, {"query": "name:{}".format(filename)}
-                    )
-                    resource_id = existing_resource["results"][0]["id"]
-                    filestore_resource = tk.get_action("resource_patch")(
-                        context,
-                        {
-                            "id": resource_id,
-                            "mimetype": mimetype,
-                            "upload": FileStorage(stream=f, filename=filename),
-                            "name": filename,
-                            "format": format,
-                            "is_datastore_cache_file": True,
-                            "datastore_resource_id": resource_info["id"],
-                        },
-                    )
+    Each file is named after the resource, and written a batch of records
+    at a time, so memory use doesnt grow with the table. Formats are
+    exported side by side, up to workers at once - each reads the table
+    with its own connection
+    Returns the files like _cache_resource does
+    """
 
-                # add details to output
-                output[format.upper()] = filestore_resource[
-                    "id"
-                ]  # put resource id for filestore resource
+    columns = export.table_columns(resource_info["id"])
 
-                # delete temp file now that we've used it
-                tk.get_action("prune")(context, {"path": val})
+    def write(format):
+        filename = "{}.{}".format(resource_info["name"].replace(os.sep, "-"), format)
+        path = os.path.join(work_dir, filename)
+        with report.stage("export", formats=[format.upper()]) as span:
+            export.write_file(export.stream(resource_info["id"], format, columns), path)
+            span["bytes"] = os.path.getsize(path)
+        return {"format": format, "epsg_code": None, "path": path}
 
-        # delete the temp directory where we stored the cached files
-        tk.get_action("prune")(context, {"path": cached_files_dir})
+    with ThreadPoolExecutor(max_workers=min(workers, len(target_formats))) as executor:
+        return list(executor.map(write, target_formats))
 
-        # put array of filepaths into package_patch call
-        # and current date into resource_patch call
-        tk.get_action("resource_patch")(
-            context,
+
+def _files_size(files):
+    # total bytes of a to_file output's files
+    return sum(os.path.getsize(path) for path in files.values() if os.path.isfile(path))
+
+
+def _append_to_cache(context, package, resource, previous_state, work_dir, report):
+    """Adds the records loaded since the last cache to the end of copies of
+    the cached CSV and JSON files, and regenerates the XML file
+
+    Returns the new cache files like _cache_resource does, or None if the
+    cached files cant be appended to - in that case the caller should
+    rebuild the cache from scratch
+    """
+
+    with report.stage("is_geospatial"):
+        if utils.is_geospatial(resource["id"], context):
+            return None
+
+    existing_cache_files = _cache_file_index(package, resource["id"])
+    package_resources = {r["id"]: r for r in package["resources"]}
+
+    # find the files we're appending to - they have to be on this server
+    cache_files = []
+    for format in ["csv", "json"]:
+        cache_resource = package_resources.get(
+            existing_cache_files.get((format.upper(), None))
+        )
+        if not cache_resource or cache_resource.get("url_type") != "upload":
+            return None
+        path = uploader.get_resource_uploader(dict(cache_resource)).get_path(
+            cache_resource["id"]
+        )
+        if not os.path.isfile(path):
+            return None
+
+        # work on copies, so nothing changes unless every file can be appended to
+        cache_files.append(
             {
-                "id": resource_info["id"],
-                "datastore_cache": output,
-                "datastore_cache_last_update": datetime.now().strftime(
-                    "%Y-%m-%dT%H:%M:%S.%f"
-                ),
-            },
+                "format": format,
+                "epsg_code": None,
+                "path": os.path.join(work_dir, cache_resource["name"]),
+            }
         )
+        with report.stage("copy_cached_file", format=format.upper()):
+            shutil.copyfile(path, cache_files[-1]["path"])
+
+    logging.info(
+        "[ckanext-opendatatoronto]--------- appending records after _id {} to cache of {}".format(
+            previous_state["max_id"], resource["id"]
+        )
+    )
+
+    csv_path, json_path = [cache_file["path"] for cache_file in cache_files]
+    try:
+        headers, _ = export.read_csv_headers(csv_path)
+        if not export.can_append_json(json_path):
+            return None
+        with report.stage("append", format="CSV") as span:
+            span["rows"] = export.append_csv(
+                csv_path,
+                export.iter_records(resource["id"], headers, previous_state["max_id"]),
+            )
+        with report.stage("append", format="JSON") as span:
+            span["rows"] = export.append_json(
+                json_path,
+                export.iter_records(resource["id"], headers, previous_state["max_id"]),
+            )
+    except Exception as e:
+        logging.info(
+            "[ckanext-opendatatoronto]--------- cant append to cache, rebuilding: " + str(e)
+        )
+        return None
+
+    # XML has no cheap way to add records, so we just regenerate that one
+    cache_files += _export_files(resource, ["xml"], 1, work_dir, report)
+
+    return cache_files
+
+
+def _cache_file_index(package, datastore_resource_id):
+    """Maps the existing cache files of a datastore resource to their ids
+
+    Cache files are keyed by (format, epsg) - epsg is None for non spatial
+    files - and also by name, to catch files from older caching runs.
+    Everything comes from the package we already have, so no extra calls
+    """
+
+    resources = {r["id"]: r for r in package["resources"]}
+    index = {}
+
+    # older cache files dont know their epsg, but the datastore resource
+    # remembers which cache files it got last time
+    datastore_cache = utils.to_dict(
+        resources.get(datastore_resource_id, {}).get("datastore_cache")
+    )
+
+    if datastore_cache:
+        for format, ids in datastore_cache.items():
+            if isinstance(ids, dict):
+                for epsg_code, resource_id in ids.items():
+                    index[(format.upper(), str(epsg_code))] = resource_id
+            else:
+                index[(format.upper(), None)] = ids
+
+    for r in resources.values():
+        if r.get("is_datastore_cache_file") not in [True, "true", "True"]:
+            continue
+        if r.get("datastore_resource_id") != datastore_resource_id:
+            continue
+
+        index[r["name"]] = r["id"]
+        if "datastore_cache_epsg" in r.keys():
+            index[(r["format"].upper(), r["datastore_cache_epsg"] or None)] = r["id"]
+
+    # only keep ids that are still in the package
+    return {k: v for k, v in index.items() if v in resources}
+
+
+def _save_cache_files(context, package, datastore_resource_id, cache_files, datastore_resource_patch):
+    """Puts cached files in the filestore as resources of the package
+
+    Patches the existing cache file for each format and epsg, if there is one,
+    and creates a new resource otherwise. The datastore resource is patched
+    with the ids of its cache files, and anything in datastore_resource_patch.
+    It all happens in one resource_bulk_upsert call
+
+    Returns the ids of the cache files, by format (and epsg)
+    """
+
+    existing_cache_files = _cache_file_index(package, datastore_resource_id)
+    output = {}
+    upserts = []
+    open_files = []
+
+    try:
+        for cache_file in cache_files:
+            format = cache_file["format"]
+            epsg_code = cache_file["epsg_code"]
+            filename = os.path.basename(cache_file["path"])
+
+            # we pick the ids of new cache files ourselves, so the datastore
+            # resource can point at them in the same call that creates them
+            resource_id = existing_cache_files.get(
+                (format.upper(), epsg_code), existing_cache_files.get(filename)
+            ) or str(uuid.uuid4())
+
+            f = open(cache_file["path"], "rb")
+            open_files.append(f)
+            upserts.append(
+                {
+                    "id": resource_id,
+                    "mimetype": "application/octet-stream",
+                    "upload": FileStorage(stream=f, filename=filename),
+                    "name": filename,
+                    "format": format,
+                    "is_datastore_cache_file": True,
+                    "datastore_resource_id": datastore_resource_id,
+                    "datastore_cache_epsg": epsg_code,
+                }
+            )
+
+            # add details to output
+            # put resource id for filestore resource
+            if epsg_code:
+                output.setdefault(format.upper(), {})[epsg_code] = resource_id
+            else:
+                output[format.upper()] = resource_id
+
+        upserts.append(
+            dict(datastore_resource_patch, id=datastore_resource_id, datastore_cache=output)
+        )
+
+        tk.get_action("resource_bulk_upsert")(
+            context, {"package_id": package["id"], "resources": upserts}
+        )
+    finally:
+        for f in open_files:
+            f.close()
 
-    logging.info("[ckanext-opendatatoronto] --- Finished Datastore Cache")
     return output
 
 
+def resource_bulk_upsert(context, data_dict):
+    """Creates or patches many resources of one package at once
+
+    Takes a package_id and a list of resources. Resources with the id of a
+    resource already in the package are patched, the rest are created.
+    Files can be uploaded with each resource, like in resource_create.
+
+    All resources are saved with a single package_update, so the package is
+    validated, committed and reindexed once - along with the package's
+    formats / last_refreshed, which are only worked out once. Resource views
+    are made once everything is saved
+
+    Because nothing goes through resource_create / resource_update, other
+    plugins' IResourceController hooks dont run for these resources - this
+    extension's own checks (unique names, upper case formats) are applied to
+    created and patched resources here instead
+    """
+
+    package_id = data_dict.get("package_id")
+    resources = data_dict.get("resources")
+
+    # make sure the call has the necessary inputs
+    if not package_id or not isinstance(resources, list):
+        raise tk.ValidationError(
+            {"constraints": ["Endpoint needs input package_id and a list of resources"]}
+        )
+
+    tk.check_access("package_update", context, {"id": package_id})
+
+    # we're about to change the package, so get a fresh copy of it
+    cache.invalidate_package(context, package_id)
+    package = tk.get_action("package_show")(context, {"id": package_id})
+    existing_resources = {r["id"]: idx for idx, r in enumerate(package["resources"])}
+
+    resource_ids = []
+    uploads = []
+    for resource in resources:
+        resource = dict(resource)
+
+        if resource.get("id") in existing_resources.keys():
+            # patch - keep whatever this input doesnt change
+            idx = existing_resources[resource["id"]]
+            if "name" in resource.keys():
+                schema.check_resource_name(package, resource)
+            resource = dict(package["resources"][idx], **resource)
+            schema.normalize_format(resource)
+            package["resources"][idx] = resource
+        else:
+            # create - like resource_create, but with an id we can know up front
+            # package_update would move a resource of another package with
+            # this id into ours, so those ids are refused
+            if resource.get("id"):
+                existing = model.Resource.get(resource["id"])
+                if existing is not None and existing.package_id != package["id"]:
+                    raise tk.ValidationError(
+                        {
+                            "constraints": [
+                                "Resource {} belongs to another package".format(
+                                    resource["id"]
+                                )
+                            ]
+                        }
+                    )
+            resource.setdefault("id", str(uuid.uuid4()))
+            resource["package_id"] = package["id"]
+            schema.prepare_resource(package, resource)
+            package["resources"].append(resource)
+
+        # take file uploads off the resources, and save them once the
+        # resources exist - this is what resource_create does too
+        size_given = "size" in resource.keys()
+        upload = uploader.get_resource_uploader(resource)
+        if "mimetype" not in resource.keys() and hasattr(upload, "mimetype"):
+            resource["mimetype"] = upload.mimetype
+        if not size_given and "url_type" in resource.keys() and hasattr(upload, "filesize"):
+            resource["size"] = upload.filesize
+
+        resource_ids.append(resource["id"])
+        uploads.append((resource["id"], upload))
+
+    context["defer_commit"] = True
+    try:
+        tk.get_action("package_update")(context, package)
+
+        # work out the package's formats / last_refreshed from the saved
+        # resources, in the same commit
+        model.Session.flush()
+        schema.update_package(context)
+    finally:
+        context.pop("defer_commit", None)
+
+    for resource_id, upload in uploads:
+        upload.upload(resource_id, uploader.get_max_resource_size())
+
+    # committing reindexes the package, once
+    model.repo.commit()
+    cache.invalidate_package(context, package["id"])
+
+    # now that everything is saved, make the views, once for the whole batch
+    package = cache.cached_action(context, "package_show", {"id": package["id"]})
+    output = {r["id"]: r for r in package["resources"] if r["id"] in resource_ids}
+    for resource_id in resource_ids:
+        schema.create_resource_views(context, output[resource_id])
+
+    return [output[resource_id] for resource_id in resource_ids]
+
+
+# chunk sizes NiFi loads datastore resources in - a datastore_create call
+# without a load_id and with this many records isnt the last of its load
+LEGACY_CHUNK_SIZES = [2000, 1999, 20000, 19999]
+
+
 @tk.chained_action
 def datastore_create_hook(original_datastore_create, context, data_dict):
     """This logic fires on "/datastore_create" which is called whenever records
@@ -449,127 +1029,246 @@ def datastore_create_hook(original_datastore_create, context, data_dict):
         "auth_user_obj"
     ], "This endpoint can be used by authorized accounts only"
     logging.info("[ckanext-opendatatoronto]------------ Done Checking Auth")
-    # 2000 and 20000 are hardcoded "chunk" sizes
     # ETLs from NiFi send data in multiple "chunks"
-    # We dont want to hit the /datastore_cache for each chunk,
-    # just the last chunk
-    # The last "chunk" wont be 2000 or 20000 records in size
-    
+    # We dont want to hit the /datastore_cache for each chunk, just once the
+    # whole load is in. Callers group their chunks with a "load_id", and mark
+    # the last chunk with "final": true (or call /datastore_load_finalize)
+    # Calls without a load_id fall back on the chunk sizes NiFi sends: a
+    # full size chunk means more are coming, and a call without records
+    # just defines the table, so neither is a complete load
+
     # We also have an optional "do not cache" input for datastore_create
     # if this is marked, caching wont occur after a final chunk
 
+    # these inputs are ours, not datastore_create's, so dont pass them on
+    data_dict = dict(data_dict)
+    load_id = data_dict.pop("load_id", None)
+    do_not_cache = tk.asbool(data_dict.pop("do_not_cache", False))
+
     if "records" not in data_dict.keys():
         numrecords = 0
     else:
         numrecords = len(data_dict["records"])
+
+    if load_id is not None:
+        final = tk.asbool(data_dict.pop("final", False))
+        # refuse chunks the session wont take before we write them, so a
+        # rejected chunk isnt stored anyway (and duplicated on retry)
+        loads.check_chunk(load_id, data_dict.get("resource_id"))
+    else:
+        final = tk.asbool(
+            data_dict.pop("final", numrecords not in LEGACY_CHUNK_SIZES)
+        ) and numrecords != 0
+
     logging.info(
         "=============================== STARTING LOAD OF {} RECORDS".format(
             str(numrecords)
         )
     )
     output = original_datastore_create(context, data_dict)
+    utils.touch_datastore(output["resource_id"])
+    utils.refresh_datastore_schema(output["resource_id"], data_dict, context)
+    utils.invalidate_catalog(output["resource_id"])
+    if data_dict.get("records") and utils.is_dqs_resource(output["resource_id"]):
+        utils.update_dqs_index(data_dict["records"])
     logging.info("[ckanext-opendatatoronto]=== LOADED {} RECORDS".format(str(numrecords)))
-    if numrecords not in [2000, 1999, 20000, 19999, 0] and not data_dict.get("do_not_cache", False):
-
-        context.pop("model")
-        context.pop("session")
-        context.pop("connection")
-        
-        #tk.enqueue_job(
-        #    fn=datastore_cache_job, 
-        #    args=[
-        #        context,
-        #        output["resource_id"],
-        #    ], 
-        #    title="cache_job - " + output["resource_id"],
-        #    rq_kwargs={"timeout":3600}
-        #    #title=output["resource_id"]+"_datastore_cache_job",
-        #    #timeout=3600
-        #)
-        tk.get_action("datastore_cache")(
-            context, {"resource_id": output["resource_id"]}
+
+    if load_id is not None:
+        session = loads.record_chunk(
+            load_id, output["resource_id"], numrecords, context["user"]
+        )
+        logging.info(
+            "[ckanext-opendatatoronto]=== LOAD {} AT {} RECORDS IN {} CHUNKS".format(
+                load_id, session["records"], session["chunks"]
+            )
         )
+        if final:
+            _finalize_load(load_id, context["user"], do_not_cache)
+
+    elif final and not do_not_cache:
+        # caching can take minutes for big resources, so we hand it off to
+        # a background worker instead of making the caller wait for it
+        enqueue_datastore_cache(output["resource_id"], context["user"])
     logging.info("[ckanext-opendatatoronto]------------ Done Checking If ready for Datastore Cache")
 
     return output
 
-def datastore_cache_job(context, resource_id):
-    """Calls datastore_cache CKAN action"""
 
-    tk.get_action("datastore_cache")(
-        context,
-        {"resource_id": resource_id}
+def _finalize_load(load_id, user, do_not_cache=False):
+    """Closes a load session, and caches its resource if this call closed it"""
+
+    session, closed_here = loads.finalize(load_id)
+    if closed_here and not do_not_cache and session.get("resource_id"):
+        enqueue_datastore_cache(session["resource_id"], user)
+    return session
+
+
+def datastore_load_begin(context, data_dict):
+    """Opens a load session for a multi-chunk datastore load
+    Returns the load_id to pass to each datastore_create chunk"""
+
+    # make sure an authorized user is making this call
+    if not context.get("auth_user_obj", None):
+        raise tk.ValidationError(
+            {"constraints": ["This endpoint can be used by authorized accounts only"]}
+        )
+
+    resource_id = data_dict.get("resource_id")
+    if resource_id:
+        tk.check_access("datastore_create", context, {"resource_id": resource_id})
+
+    return loads.begin(resource_id, context["user"], data_dict.get("load_id"))
+
+
+def datastore_load_finalize(context, data_dict):
+    """Marks a load session as complete, and caches its resource
+    Caching only happens the first time a load is finalized"""
+
+    # make sure an authorized user is making this call
+    if not context.get("auth_user_obj", None):
+        raise tk.ValidationError(
+            {"constraints": ["This endpoint can be used by authorized accounts only"]}
+        )
+
+    if "load_id" not in data_dict.keys():
+        raise tk.ValidationError({"constraints": ["Endpoint needs input load_id"]})
+
+    session = loads.show(data_dict["load_id"])
+    if session and session.get("resource_id"):
+        tk.check_access(
+            "datastore_create", context, {"resource_id": session["resource_id"]}
+        )
+
+    return _finalize_load(
+        data_dict["load_id"],
+        context["user"],
+        tk.asbool(data_dict.get("do_not_cache", False)),
     )
 
-@tk.chained_action
-def datastore_delete_hook(original_datastore_delete, context, data_dict):
-    """This logic fires on "/datastore_delete" which is called whenever records
-    are deleted from the datastore
 
-    When this endpoint is hit, this logic ensures critical values from the tags
-    package are not deleted.
+@tk.side_effect_free
+def datastore_load_show(context, data_dict):
+    """Returns stats of a load session by load_id,
+    or the latest load sessions of a resource by resource_id"""
+
+    if "load_id" in data_dict.keys():
+        session = loads.show(data_dict["load_id"])
+        if session is None:
+            raise tk.ObjectNotFound("Unknown load_id {}".format(data_dict["load_id"]))
+        if session.get("resource_id"):
+            tk.check_access("resource_show", context, {"id": session["resource_id"]})
+        return session
+
+    if "resource_id" in data_dict.keys():
+        tk.check_access("resource_show", context, {"id": data_dict["resource_id"]})
+        return loads.history(data_dict["resource_id"])
+
+    raise tk.ValidationError(
+        {"constraints": ["Endpoint needs input load_id or resource_id"]}
+    )
 
-    If these values are deleted, datasets will not be able to get updates
+
+@tk.side_effect_free
+def datastore_cache_status(context, data_dict):
+    """Returns where datastore_cache builds are at
+
+    For a resource_id, or each datastore resource of a package_id: whether
+    its build is queued, running (and in which stage), finished or failed,
+    with the report of its latest build
+    Always returns the datastore_cache queue's depth, how long its oldest
+    job has waited, and how long the latest builds took
     """
 
     # make sure an authorized user is making this call
-    logging.info("[ckanext-opendatatoronto]------------ Checking Auth")
-    tk.check_access("datastore_delete", context, data_dict)
-    assert context[
-        "auth_user_obj"
-    ], "This endpoint can be used by authorized accounts only"
-    logging.info("[ckanext-opendatatoronto]------------ Done Checking Auth")
+    if not context.get("auth_user_obj", None):
+        raise tk.ValidationError(
+            {"constraints": ["This endpoint can be used by authorized accounts only"]}
+        )
 
-    # checking if this targets the metadata-catalog package
-    metadata_catalog_package = tk.get_action("package_show")(
-        context, {"id": "metadata-catalog"}
-    )
-    metadata_catalog_resources = {
-        r["id"]: r["name"]
-        for r in metadata_catalog_package["resources"]
-        if r["datastore_active"] in [True, "True", "true"]
-    }
-    # if it does, make sure it doesnt target important metadata-catalog
-    if data_dict["id"] in metadata_catalog_resources.keys():
-        if metadata_catalog_resources[data_dict["id"]] in [
-            "Owner Division",
-            "Refresh Rate",
-            "Dataset Category",
-        ]:
-            # if we delete important metadata-catalog, ensure we dont delete all values
-            if "filters" not in data_dict.keys():
-                raise tk.ValidationError(
-                    {
-                        "constraints": [
-                            "Not allowed to bulk delete from {}".format(
-                                metadata_catalog_resources[data_dict["id"]]
-                            )
-                        ]
-                    }
+    resource_ids = []
+    if "package_id" in data_dict.keys():
+        package = cache.cached_action(
+            context, "package_show", {"id": data_dict["package_id"]}
+        )
+        resource_ids = [
+            resource["id"]
+            for resource in package["resources"]
+            if resource["datastore_active"] in [True, "true", "True"]
+        ]
+    elif "resource_id" in data_dict.keys():
+        tk.check_access("resource_show", context, {"id": data_dict["resource_id"]})
+        resource_ids = [data_dict["resource_id"]]
+
+    output = status.queue_status()
+    output["resources"] = [status.show(resource_id) for resource_id in resource_ids]
+    return output
+
+
+def enqueue_datastore_cache(resource_id, user):
+    """Puts a datastore_cache job for the input resource on the job queue
+
+    If a job for this resource is already waiting on the queue, we dont add
+    another one - the waiting job will cache the latest data anyway.
+    Once a job starts running, new requests will queue up a fresh job, so
+    records loaded mid-run are never left out of the cache
+
+    The resource's pending slot (see status.py) decides who queues the job:
+    it's claimed with a compare-and-set, so of any callers that find it
+    empty or stale, only one wins. The slot has no expiry - it's emptied
+    when its job starts, however long the queue is
+    """
+    queue_name = status.queue_name()
+    timeout = tk.asint(tk.config.get("ckanext.opendata.datastore_cache_timeout", 3600))
+    queue = jobs.get_queue(queue_name)
+    job_id = "datastore_cache-{}-{}".format(resource_id, uuid.uuid4())
+
+    while True:
+        expected, pending_job_id, _ = status.pending(resource_id)
+        if pending_job_id is not None:
+            # a job still waiting (or being put) on the queue will do
+            is_waiting, pending_job = status.waiting_job(resource_id, queue)
+            if is_waiting:
+                logging.info(
+                    "[ckanext-opendatatoronto] --- Datastore Cache already queued for "
+                    + resource_id
                 )
+                return pending_job
 
-            # make sure we dont delete values belonging to the metadata-catalog package
-            elif "filters" in data_dict.keys():
-                metadata_catalog_metadata = [
-                    metadata_catalog_package["owner_division"],
-                    metadata_catalog_package["refresh_rate"],
-                    metadata_catalog_package["dataset_category"],
-                ]
+        # the slot is empty, or its job was cleared from the queue - claim it,
+        # unless someone changed it since we looked, then look again
+        if status.claim_pending(resource_id, job_id, expected):
+            break
 
-                incoming_deletes = data_dict["filters"].values()
+    logging.info("[ckanext-opendatatoronto] --- Queueing Datastore Cache for " + resource_id)
+    return tk.enqueue_job(
+        datastore_cache_job,
+        args=[resource_id, user],
+        title="cache_job - " + resource_id,
+        queue=queue_name,
+        rq_kwargs={"job_id": job_id, "timeout": timeout},
+    )
 
-                matches = set(metadata_catalog_metadata) & set(incoming_deletes)
 
-                if matches:
-                    raise tk.ValidationError(
-                        {
-                            "constraints": [
-                                "Not allowed to delete tag {}".format(str(matches))
-                            ]
-                        }
-                    )
+def datastore_cache_job(resource_id, user):
+    """Calls datastore_cache CKAN action from a background worker"""
+
+    # free up the "pending" slot right away, so loads that land while we run
+    # get a job of their own
+    current_job = get_current_job()
+    if current_job:
+        status.release_pending(resource_id, current_job.id)
 
-    original_datastore_delete(context, data_dict)
+    context = {"user": user, "auth_user_obj": model.User.get(user)}
+    try:
+        tk.get_action("datastore_cache")(
+            context,
+            {"resource_id": resource_id}
+        )
+    except Exception as e:
+        # datastore_cache marks the builds it started - this catches
+        # anything that failed before it got that far
+        status.failed(resource_id, str(e))
+        raise
 
 
 @tk.chained_action
@@ -584,80 +1283,201 @@ def datastore_delete_hook(original_datastore_delete, context, data_dict):
     """
 
     # make sure an authorized user is making this call
-    logging.info("------------ Checking Auth")
+    logging.info("[ckanext-opendatatoronto]------------ Checking Auth")
     tk.check_access("datastore_delete", context, data_dict)
     assert context[
         "auth_user_obj"
     ], "This endpoint can be used by authorized accounts only"
-    logging.info("------------ Done Checking Auth")
+    logging.info("[ckanext-opendatatoronto]------------ Done Checking Auth")
+
+    # datastore_delete takes the resource as "resource_id" or "id"
+    resource_id = data_dict.get("resource_id", data_dict.get("id"))
+
+    # checking if this targets a protected metadata-catalog resource
+    protected = utils.protected_lookups()
+    resource_name = protected["resources"].get(resource_id)
 
-    # checking if this targets the metadata-catalog package
-    metadata_catalog_package = tk.get_action("package_show")(
-        context, {"id": "metadata-catalog"}
-    )
-    metadata_catalog_resources = {
-        r["id"]: r["name"]
-        for r in metadata_catalog_package["resources"]
-        if r["datastore_active"] in [True, "True", "true"]
-    }
     # if it does, make sure it doesnt target important metadata-catalog
-    if data_dict["id"] in metadata_catalog_resources.keys():
-        if metadata_catalog_resources[data_dict["id"]] in [
-            "Owner Division",
-            "Refresh Rate",
-            "Dataset Category",
-        ]:
-            # if we delete important metadata-catalog, ensure we dont delete all values
-            if "filters" not in data_dict.keys():
-                raise tk.ValidationError(
-                    {
-                        "constraints": [
-                            "Not allowed to bulk delete from {}".format(
-                                metadata_catalog_resources[data_dict["id"]]
-                            )
-                        ]
-                    }
-                )
+    if resource_name is not None:
+        # if we delete important metadata-catalog, ensure we dont delete all values
+        if "filters" not in data_dict.keys():
+            raise tk.ValidationError(
+                {
+                    "constraints": [
+                        "Not allowed to bulk delete from {}".format(resource_name)
+                    ]
+                }
+            )
 
-            # make sure we dont delete values belonging to the metadata-catalog package
-            elif "filters" in data_dict.keys():
-                metadata_catalog_metadata = [
-                    metadata_catalog_package["owner_division"],
-                    metadata_catalog_package["refresh_rate"],
-                    metadata_catalog_package["dataset_category"],
-                ]
+        # make sure we dont delete values belonging to the metadata-catalog package
+        incoming_deletes = data_dict["filters"].values()
 
-                incoming_deletes = data_dict["filters"].values()
+        matches = set(protected["values"]) & set(incoming_deletes)
 
-                matches = set(metadata_catalog_metadata) & set(incoming_deletes)
+        if matches:
+            raise tk.ValidationError(
+                {
+                    "constraints": [
+                        "Not allowed to delete tag {}".format(str(matches))
+                    ]
+                }
+            )
 
-                if matches:
-                    raise tk.ValidationError(
-                        {
-                            "constraints": [
-                                "Not allowed to delete tag {}".format(str(matches))
-                            ]
-                        }
-                    )
+    output = original_datastore_delete(context, data_dict)
+    utils.touch_datastore(resource_id)
+    utils.invalidate_catalog(resource_id)
+    # without filters, the whole table is dropped
+    if "filters" not in data_dict.keys():
+        cache.invalidate_resource(context, resource_id)
+        utils.invalidate_datastore_schema(resource_id)
+    if utils.is_dqs_resource(resource_id):
+        utils.clear_dqs_index()
+
+    return output
 
-    original_datastore_delete(context, data_dict)
+
+@tk.chained_action
+def datastore_upsert_hook(original_datastore_upsert, context, data_dict):
+    """This logic fires on "/datastore_upsert", and notes when the
+    resource's records changed, so /download_resource knows its cached
+    files are out of date"""
+
+    output = original_datastore_upsert(context, data_dict)
+    utils.touch_datastore(data_dict["resource_id"])
+    return output
 
 
 @tk.side_effect_free
 def reindex_solr(context, data_dict):
-    """Endpoint to force a reindex of solr in the target environment
+    """Endpoint to refresh the solr index in the target environment
     This wont cause a reindex in an associated delivery environment, though
     The solr-sqs package is responsible for that
+
+    Packages are reindexed in batches by background jobs - this returns
+    right away with a run_id to pass to reindex_solr_status. Inputs
+    (all optional) limit which packages are reindexed:
+        since: only packages modified since this date / datetime
+        organization: only packages of this organization
+        ids: only these packages, as a list or comma separated string
+    batch_size and commit_interval override the configured defaults
     """
     # make sure an authorized user is making this call
-    assert context[
-        "auth_user_obj"
-    ], "This endpoint can be used by authorized accounts only"
+    if not context.get("auth_user_obj", None):
+        raise tk.ValidationError(
+            {"constraints": ["This endpoint can be used by authorized accounts only"]}
+        )
 
-    os.system(
-        """
-        . /usr/lib/ckan/default/bin/activate
-        ckan --config=/etc/ckan/default/production.ini search-index rebuild -r
-    """
+    since = data_dict.get("since")
+    if since:
+        since = utils.str_to_datetime(since)
+        if since is None:
+            raise tk.ValidationError(
+                {"constraints": ["since should look like YYYY-MM-DDTHH:MM:SS"]}
+            )
+
+    ids = data_dict.get("ids")
+    if isinstance(ids, str):
+        ids = [package_id.strip() for package_id in ids.split(",") if package_id.strip()]
+
+    batch_size = tk.asint(
+        data_dict.get(
+            "batch_size", tk.config.get("ckanext.opendata.reindex_batch_size", 100)
+        )
     )
-    return "Complete"
+    commit_interval = tk.asint(
+        data_dict.get(
+            "commit_interval",
+            tk.config.get("ckanext.opendata.reindex_commit_interval", 1000),
+        )
+    )
+    if batch_size < 1 or commit_interval < 1:
+        raise tk.ValidationError(
+            {"constraints": ["batch_size and commit_interval should be at least 1"]}
+        )
+
+    package_ids = reindex.package_ids(since, data_dict.get("organization"), ids)
+
+    return reindex.start(package_ids, context["user"], batch_size, commit_interval)
+
+
+@tk.side_effect_free
+def reindex_solr_status(context, data_dict):
+    """Returns how far along a reindex_solr run is: packages processed,
+    remaining and failed, and the latest errors
+    Without a run_id, the latest run is returned"""
+
+    # make sure an authorized user is making this call
+    if not context.get("auth_user_obj", None):
+        raise tk.ValidationError(
+            {"constraints": ["This endpoint can be used by authorized accounts only"]}
+        )
+
+    run = reindex.show(data_dict.get("run_id"))
+    if run is None:
+        raise tk.ObjectNotFound("No reindex run found")
+
+    return run
+
+
+def resource_views_backfill(context, data_dict):
+    """Queues a background job that creates the views any resource is missing
+    Resumes an interrupted backfill, unless "restart" is true"""
+
+    tk.check_access("sysadmin", context, data_dict)
+
+    batch_size = tk.asint(data_dict.get("batch_size", 500))
+    restart = tk.asbool(data_dict.get("restart", False))
+
+    job = tk.enqueue_job(
+        backfill.backfill_job,
+        args=[batch_size, restart],
+        title="resource_views_backfill",
+        rq_kwargs={"timeout": 24 * 60 * 60},
+    )
+
+    return {"job_id": job.id, "progress": backfill.show()}
+
+
+@tk.side_effect_free
+def resource_views_backfill_status(context, data_dict):
+    """Returns how far the current (or last) view backfill got"""
+
+    tk.check_access("sysadmin", context, data_dict)
+
+    return backfill.show()
+
+
+@tk.side_effect_free
+def opendata_metrics(context, data_dict):
+    """Returns call counts, errors, nested calls and latency histograms of
+    this extension's actions and hooks, added up over every CKAN process
+
+    Numbers reach redis every few seconds, so the latest calls may not be
+    in yet. Pass format=prometheus for the prometheus text format. To start
+    counting from zero, see opendata_metrics_reset
+    """
+
+    tk.check_access("sysadmin", context, data_dict)
+
+    metrics.flush()
+    output = metrics.read()
+
+    if data_dict.get("format") == "prometheus":
+        return metrics.prometheus_text(output)
+    return output
+
+
+def opendata_metrics_reset(context, data_dict):
+    """Starts every CKAN process' metrics over from zero
+    Returns the metrics as they were before the reset
+
+    Not side effect free, so it can only be called with a POST
+    """
+
+    tk.check_access("sysadmin", context, data_dict)
+
+    metrics.flush()
+    output = metrics.read()
+    metrics.reset()
+
+    return output
@@ -0,0 +1,195 @@
+"""Creates the views create_resource_views would have made, for every resource
+that's missing them
+
+Used when we roll out a new view type, or after fixing a view's config.
+Instead of a resource_view_list (and a datastore lookup) per resource, each
+batch of resources is checked with 2 queries: one against CKAN's database
+for existing views, and one against the datastore for geometry columns.
+
+Each batch's views are committed together, and the id of the last resource
+checked is saved in redis after every commit, so an interrupted backfill
+picks up where it left off:
+    ckanext-opendata:<site_id>:view_backfill
+"""
+
+from ckan.lib.redis import connect_to_redis
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+from ckanext.datastore.backend.postgres import get_read_engine
+import sqlalchemy as sa
+
+from . import schema, utils
+from datetime import datetime
+
+import logging
+
+# integer fields of the progress hash - everything else is returned as a string
+INT_FIELDS = ["checked", "created"]
+
+# the next batch of resources, with the views they already have
+BATCH_QUERY = """
+    SELECT r.id,
+        coalesce(r.extras, '{}')::json ->> 'datastore_active'
+            IN ('true', 'True') AS datastore_active,
+        coalesce(r.extras, '{}')::json ->> 'is_datastore_cache_file'
+            IN ('true', 'True') AS is_datastore_cache_file,
+        array_remove(array_agg(v.view_type), NULL) AS view_types
+    FROM (
+        SELECT resource.id, resource.extras
+        FROM resource
+        JOIN package ON package.id = resource.package_id
+        WHERE resource.state = 'active'
+            AND package.state = 'active'
+            AND resource.id > :after_id
+        ORDER BY resource.id
+        LIMIT :batch_size
+    ) r
+    LEFT JOIN resource_view v ON v.resource_id = r.id
+    GROUP BY r.id, r.extras
+    ORDER BY r.id
+"""
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _progress_key():
+    return utils.redis_key("view_backfill")
+
+
+def show():
+    """Returns the progress of the current (or last) backfill, or None"""
+
+    progress = connect_to_redis().hgetall(_progress_key())
+    if not progress:
+        return None
+
+    output = {k.decode("utf-8"): v.decode("utf-8") for k, v in progress.items()}
+    for field in INT_FIELDS:
+        output[field] = int(output.get(field, 0))
+    return output
+
+
+def _geospatial(resource_ids):
+    # which of these datastore tables have a geometry column
+    if not resource_ids:
+        return set()
+
+    engine = get_read_engine()
+    with engine.connect() as connection:
+        rows = connection.execute(
+            sa.text(
+                """
+                SELECT table_name FROM information_schema.columns
+                WHERE column_name = 'geometry' AND table_name = ANY(:resource_ids)
+                """
+            ),
+            resource_ids=list(resource_ids),
+        )
+        return {row[0] for row in rows}
+
+
+def missing_views(rows):
+    """Returns (resource_id, view_type) for each view a batch of resources is
+    missing, by the same rules as schema.create_resource_views"""
+
+    rows = [row for row in rows if not row["is_datastore_cache_file"]]
+    geospatial = _geospatial(
+        [
+            row["id"]
+            for row in rows
+            if row["datastore_active"] and "recline_map_view" not in row["view_types"]
+        ]
+    )
+
+    output = []
+    for row in rows:
+        wanted = ["dqs_view"]
+        if row["datastore_active"]:
+            wanted.append("recline_view")
+            if row["id"] in geospatial:
+                wanted.append("recline_map_view")
+
+        output += [
+            (row["id"], view_type)
+            for view_type in wanted
+            if view_type not in row["view_types"]
+        ]
+
+    return output
+
+
+def backfill(batch_size=500, restart=False, echo=None):
+    """Creates missing views for every active resource, a batch at a time
+
+    If the last backfill was interrupted, this resumes from its last
+    committed batch, unless restart is True
+    echo, if given, is called with a line of progress after each batch
+    Returns the final progress, like show()
+    """
+
+    redis_conn = connect_to_redis()
+    key = _progress_key()
+
+    progress = show()
+    if restart or progress is None or progress.get("status") != "running":
+        redis_conn.delete(key)
+        redis_conn.hset(key, "checkpoint", "")
+        redis_conn.hset(key, "started", _now())
+    redis_conn.hset(key, "status", "running")
+    redis_conn.hdel(key, "finished")
+
+    site_user = tk.get_action("get_site_user")({"ignore_auth": True}, {})
+    after_id = show()["checkpoint"]
+
+    while True:
+        rows = [
+            dict(row)
+            for row in model.Session.execute(
+                sa.text(BATCH_QUERY),
+                {"after_id": after_id, "batch_size": batch_size},
+            )
+        ]
+        if not rows:
+            break
+
+        # create this batch's views in one transaction
+        context = {
+            "user": site_user["name"],
+            "ignore_auth": True,
+            "defer_commit": True,
+        }
+        missing = missing_views(rows)
+        for resource_id, view_type in missing:
+            tk.get_action("resource_view_create")(
+                dict(context), schema.view_definitions(resource_id)[view_type]
+            )
+        model.repo.commit()
+
+        # only move the checkpoint once the batch is committed
+        after_id = rows[-1]["id"]
+        pipe = redis_conn.pipeline()
+        pipe.hset(key, "checkpoint", after_id)
+        pipe.hincrby(key, "checked", len(rows))
+        pipe.hincrby(key, "created", len(missing))
+        pipe.execute()
+
+        progress = show()
+        message = "Checked {} resources, created {} views (up to {})".format(
+            progress["checked"], progress["created"], after_id
+        )
+        logging.info("[ckanext-opendatatoronto] --- View backfill: " + message)
+        if echo is not None:
+            echo(message)
+
+    redis_conn.hset(key, "status", "finished")
+    redis_conn.hset(key, "finished", _now())
+
+    return show()
+
+
+def backfill_job(batch_size, restart):
+    """Runs a backfill from a background worker"""
+
+    backfill(batch_size, restart)
@@ -0,0 +1,245 @@
+"""Caching for the CKAN calls this extension makes over and over
+
+Request-scoped: results of read actions like package_show are kept in the
+action context, so one request (or one background job) serializes a package
+at most once. Anything that writes to a package has to invalidate it here.
+
+Shared: expensive results, like the ETL catalog, are kept in redis for every
+CKAN worker to use, with a copy in each process' memory. Each value has a
+version in redis - invalidating a value bumps its version, which every
+process sees on its next read.
+"""
+
+from ckan.lib.redis import connect_to_redis
+import ckan.plugins.toolkit as tk
+
+from . import utils
+
+from collections import OrderedDict
+
+import json
+import threading
+import time
+
+# how long a worker waits for another worker to compute a shared value
+# before computing it itself
+LOCK_TIMEOUT = 30
+
+# this process' copies of shared values, by name
+_local_values = {}
+_local_locks = {}
+_local_locks_lock = threading.Lock()
+
+# where results are kept in the context
+CONTEXT_KEY = "opendata_action_cache"
+
+# read actions we keep results of, and how to tell which package a result
+# belongs to, so we can drop it when that package changes
+CACHED_ACTIONS = {
+    "package_show": lambda result: result["id"],
+    "resource_show": lambda result: result["package_id"],
+    "datastore_info": lambda result: None,
+}
+
+
+def cached_action(context, action, data_dict):
+    """Runs a read action, or returns its result from earlier in this request
+
+    Only plain {"id": ...} calls are cached - anything with extra inputs
+    goes straight to the action. Results are shared, so dont modify them
+    """
+
+    if context is None or action not in CACHED_ACTIONS or list(data_dict.keys()) != ["id"]:
+        return tk.get_action(action)(context, data_dict)
+
+    cache = context.setdefault(CONTEXT_KEY, {})
+    key = (action, data_dict["id"])
+
+    if key not in cache:
+        result = tk.get_action(action)(context, data_dict)
+        entry = {"result": result, "package_id": CACHED_ACTIONS[action](result)}
+
+        # packages can be asked for by id or name - remember both
+        cache[key] = entry
+        if action == "package_show":
+            cache[(action, result["id"])] = entry
+            cache[(action, result["name"])] = entry
+
+    return cache[key]["result"]
+
+
+def invalidate_package(context, package_id):
+    """Drops cached results belonging to a package, after it was changed
+    package_id can be the package's id or its name"""
+
+    cache = (context or {}).get(CONTEXT_KEY)
+    if not cache:
+        return
+
+    # resolve a name to the id results are filed under
+    entry = cache.get(("package_show", package_id))
+    if entry is not None:
+        package_id = entry["package_id"]
+
+    for key in [k for k, v in cache.items() if v["package_id"] == package_id]:
+        cache.pop(key)
+
+
+def invalidate_resource(context, resource_id):
+    """Drops cached results about a datastore resource, after its table changed"""
+
+    cache = (context or {}).get(CONTEXT_KEY)
+    if cache:
+        cache.pop(("datastore_info", resource_id), None)
+
+
+def _shared_keys(name):
+    key = utils.redis_key("cache", name)
+    return key + ":value", key + ":version", key + ":lock"
+
+
+def _local_lock(name):
+    # one lock per name, so only one thread per process computes a value
+    with _local_locks_lock:
+        return _local_locks.setdefault(name, threading.Lock())
+
+
+def get_or_set(name, compute, ttl):
+    """Returns a shared value, calling compute() to make it if it's missing,
+    expired or invalidated
+
+    While one worker computes a value, other workers wait for its result
+    instead of all computing it at once. compute() must return something
+    json serializable
+    """
+
+    redis_conn = connect_to_redis()
+    value_key, version_key, lock_key = _shared_keys(name)
+    version = int(redis_conn.get(version_key) or 0)
+
+    # our own copy is good if it's fresh and no one has invalidated it
+    local = _local_values.get(name)
+    if local and local["version"] == version and local["expires"] > time.time():
+        return local["value"]
+
+    with _local_lock(name):
+        local = _local_values.get(name)
+        if local and local["version"] == version and local["expires"] > time.time():
+            return local["value"]
+
+        deadline = time.time() + LOCK_TIMEOUT
+        while True:
+            # another worker may have stored this value already
+            # our copy expires with the shared value, not ttl from now, so
+            # it's never older than ttl
+            shared = redis_conn.get(value_key)
+            if shared is not None:
+                shared = json.loads(shared)
+                if shared["version"] == version:
+                    value = shared["value"]
+                    expires = shared.get("expires", time.time() + ttl)
+                    break
+
+            # otherwise, whoever gets the lock computes it
+            if redis_conn.set(lock_key, 1, nx=True, ex=LOCK_TIMEOUT):
+                try:
+                    value = compute()
+                    expires = time.time() + ttl
+                    redis_conn.set(
+                        value_key,
+                        json.dumps({"version": version, "value": value, "expires": expires}),
+                        ex=ttl,
+                    )
+                finally:
+                    redis_conn.delete(lock_key)
+                break
+
+            # dont wait forever on a worker that died mid-compute
+            if time.time() > deadline:
+                value = compute()
+                expires = time.time() + ttl
+                break
+            time.sleep(0.1)
+
+        _local_values[name] = {
+            "version": version,
+            "expires": expires,
+            "value": value,
+        }
+
+    return value
+
+
+def invalidate(name):
+    """Makes every worker recompute a shared value on its next read"""
+
+    value_key, version_key, _ = _shared_keys(name)
+    pipe = connect_to_redis().pipeline()
+    pipe.incr(version_key)
+    pipe.delete(value_key)
+    pipe.execute()
+
+
+def generation(name):
+    """Returns the current generation of a group of cached values
+    Values cached under an older generation shouldnt be used any more"""
+
+    return int(connect_to_redis().get(utils.redis_key("generation", name)) or 0)
+
+
+def bump_generation(name):
+    """Retires every value cached under the current generation, in every process"""
+
+    return connect_to_redis().incr(utils.redis_key("generation", name))
+
+
+class LRUCache(object):
+    """A size bounded cache with a TTL, for values only this process needs
+
+    When it's full, the least recently used value makes room for new ones.
+    Hits and misses are counted, see stats()
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._values[key]
+                self.misses += 1
+                return default
+            self._values.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = (time.time() + self.ttl, value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._values),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
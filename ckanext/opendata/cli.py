@@ -0,0 +1,37 @@
+"""Commands this extension adds to the ckan command line, e.g.
+
+    ckan --config=/etc/ckan/default/production.ini opendata backfill-views
+"""
+
+import click
+
+from . import backfill
+
+
+@click.group(short_help="Open Data Toronto maintenance commands")
+def opendata():
+    pass
+
+
+@opendata.command("backfill-views")
+@click.option(
+    "--batch-size", default=500, show_default=True,
+    help="How many resources are checked and committed at a time",
+)
+@click.option(
+    "--restart", is_flag=True,
+    help="Start from the first resource, even if the last backfill was interrupted",
+)
+def backfill_views(batch_size, restart):
+    """Creates the DQS, data explorer and map views that resources are missing"""
+
+    progress = backfill.backfill(batch_size, restart, click.echo)
+    click.echo(
+        "Done: checked {} resources, created {} views".format(
+            progress["checked"], progress["created"]
+        )
+    )
+
+
+def get_commands():
+    return [opendata]
@@ -0,0 +1,280 @@
+"""Serves /download_resource/<resource_id>
+
+Datastore resources are served from their datastore_cache files when those
+are up to date - that is, when the datastore_cache run that made them
+started after the resource's records last changed (see
+utils.touch_datastore). Otherwise the file is converted from the datastore
+on the spot: non spatial formats are streamed straight out of postgres,
+spatial ones are made by to_file.
+
+Cached and converted files go out with ETag and Last-Modified headers, and
+answer If-None-Match / If-Modified-Since with a 304 and Range with a 206,
+so repeat downloads and resumed downloads cost next to nothing. Streamed
+downloads have the same validators, but cant be resumed. Files converted
+from tables we dont know the last change of go out without validators.
+
+Inputs, as query string parameters:
+    format: csv (default), json or xml - or csv, geojson, gpkg or shp for
+        spatial resources
+    projection: 4326 (default) or 2952, for spatial resources
+"""
+
+from ckan.lib import uploader
+import ckan.plugins.toolkit as tk
+from flask import Blueprint, Response, request, send_file, stream_with_context
+from werkzeug.http import dump_options_header, is_resource_modified
+
+from . import export, metrics, utils
+from datetime import timezone
+from urllib.parse import quote
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import unicodedata
+
+# formats and projections we serve
+TABULAR_FORMATS = ["csv", "json", "xml"]
+SPATIAL_FORMATS = ["csv", "geojson", "gpkg", "shp"]
+EPSG_CODES = ["4326", "2952"]
+
+MIMETYPES = {
+    "csv": "text/csv",
+    "json": "application/json",
+    "xml": "application/xml",
+    "geojson": "application/geo+json",
+    "gpkg": "application/geopackage+sqlite3",
+    "shp": "application/zip",
+}
+
+download = Blueprint("opendata_download", __name__)
+
+
+def _context():
+    return {"user": tk.c.user, "auth_user_obj": tk.c.userobj}
+
+
+def is_cache_fresh(resource):
+    """True if a datastore resource's cached files have all of its records
+
+    Records that changed after the last datastore_cache run started could
+    be missing from its files. If we dont know of any change, the files
+    are as good as the datastore
+    """
+
+    started = utils.datastore_cache_started(resource)
+    if started is None:
+        return False
+
+    modified = utils.datastore_last_modified(resource["id"])
+    return modified is None or started >= modified
+
+
+def _cached_file_id(resource, format, epsg_code):
+    # datastore_cache is {FORMAT: id} for non spatial resources, and
+    # {FORMAT: {epsg: id}} for spatial ones
+    datastore_cache = utils.to_dict(resource.get("datastore_cache")) or {}
+    entry = datastore_cache.get(format.upper())
+    if isinstance(entry, dict):
+        return entry.get(epsg_code)
+    return entry
+
+
+def _validators(resource, format, epsg_code):
+    """Returns the ETag and Last-Modified of a file converted from the
+    datastore - they change whenever the datastore's records do
+
+    Both are None if we dont know when the records last changed (they
+    havent since we started keeping track, or redis lost track). A later
+    change we missed would leave any validators we made up stuck, so those
+    files go out without any
+    """
+
+    modified = utils.datastore_last_modified(resource["id"])
+    if modified is None:
+        return None, None
+
+    etag = hashlib.md5(
+        "{}|{}|{}|{}".format(
+            resource["id"], modified.isoformat(), format, epsg_code
+        ).encode("utf-8")
+    ).hexdigest()
+    # we keep local times, werkzeug wants naive UTC ones
+    modified = modified.astimezone(timezone.utc).replace(tzinfo=None)
+    return etag, modified
+
+
+def _is_not_modified(etag, modified):
+    # True if the client already has the file with these validators
+    if etag is None:
+        return False
+    return not is_resource_modified(request.environ, etag=etag, last_modified=modified)
+
+
+def _set_validators(response, etag, modified):
+    if etag is not None:
+        response.set_etag(etag)
+        response.last_modified = modified
+    return response
+
+
+def _attachment(filename):
+    """Returns a Content-Disposition header for a download named filename,
+    the way send_file makes it: quoted, and with a UTF-8 copy of names
+    latin-1 cant hold, as HTTP headers are latin-1"""
+
+    try:
+        filename.encode("latin-1")
+        options = {"filename": filename}
+    except UnicodeEncodeError:
+        options = {
+            "filename": unicodedata.normalize("NFKD", filename)
+            .encode("ascii", "ignore")
+            .decode("ascii"),
+            "filename*": "UTF-8''{}".format(quote(filename, safe="")),
+        }
+    return dump_options_header("attachment", options)
+
+
+def _send_cached_file(cache_resource_id, format):
+    """Sends a cached file from the filestore, or None if we cant find it"""
+
+    try:
+        cache_resource = tk.get_action("resource_show")(
+            _context(), {"id": cache_resource_id}
+        )
+    except tk.ObjectNotFound:
+        return None
+
+    if cache_resource.get("url_type") != "upload":
+        return tk.redirect_to(cache_resource["url"])
+
+    path = uploader.get_resource_uploader(cache_resource).get_path(cache_resource["id"])
+    if not os.path.isfile(path):
+        return None
+
+    # conditional makes flask add an ETag and Last-Modified from the file,
+    # and answer conditional and Range requests. Browsers have to check
+    # back every time, as the file is replaced when the data changes
+    return send_file(
+        path,
+        mimetype=MIMETYPES.get(format, "application/octet-stream"),
+        as_attachment=True,
+        attachment_filename=cache_resource["name"],
+        conditional=True,
+        cache_timeout=0,
+    )
+
+
+def _stream_file(resource, format, filename):
+    """Streams a non spatial datastore resource in format, a batch of
+    records at a time"""
+
+    etag, modified = _validators(resource, format, None)
+    if _is_not_modified(etag, modified):
+        return _set_validators(Response(status=304), etag, modified)
+
+    chunks = export.stream(resource["id"], format)
+    response = Response(
+        stream_with_context(chunk.encode("utf-8") for chunk in chunks),
+        mimetype=MIMETYPES[format],
+    )
+    response.headers["Content-Disposition"] = _attachment(filename)
+    response.headers["Accept-Ranges"] = "none"
+    return _set_validators(response, etag, modified)
+
+
+def _convert_file(resource, format, epsg_code, filename):
+    """Converts a spatial datastore resource with to_file, and sends the
+    file - it's deleted once it's sent"""
+
+    etag, modified = _validators(resource, format, epsg_code)
+    if _is_not_modified(etag, modified):
+        return _set_validators(Response(status=304), etag, modified)
+
+    context = _context()
+    output = tk.get_action("to_file")(
+        context,
+        {
+            "resource_id": resource["id"],
+            "target_formats": [format],
+            "source_epsg": 4326,
+            "target_epsgs": [int(epsg_code)],
+        },
+    )
+    converted_path = list(output.values())[0]
+
+    # move the file somewhere of our own, so to_file's files can be pruned
+    # now, and ours once the response is sent
+    work_dir = tempfile.mkdtemp(dir=export.export_dir())
+    path = os.path.join(work_dir, filename)
+    shutil.move(converted_path, path)
+    tk.get_action("prune")(context, {"path": os.path.dirname(converted_path)})
+
+    response = send_file(
+        path,
+        mimetype=MIMETYPES[format],
+        as_attachment=True,
+        attachment_filename=filename,
+        add_etags=False,
+        cache_timeout=0,
+    )
+    _set_validators(response, etag, modified)
+    response.make_conditional(
+        request, accept_ranges=True, complete_length=os.path.getsize(path)
+    )
+    response.call_on_close(lambda: shutil.rmtree(work_dir, ignore_errors=True))
+    return response
+
+
+@download.route("/download_resource/<resource_id>")
+@metrics.timed("view:download_resource")
+def download_resource(resource_id):
+    try:
+        resource = tk.get_action("resource_show")(_context(), {"id": resource_id})
+    except tk.ObjectNotFound:
+        return tk.abort(404, tk._("Resource not found"))
+    except tk.NotAuthorized:
+        return tk.abort(403, tk._("Not authorized to download this resource"))
+
+    # filestore and link resources are served from where they are
+    if resource.get("datastore_active") not in [True, "true", "True"]:
+        return tk.redirect_to(resource["url"])
+
+    geospatial = utils.is_geospatial(resource_id, _context())
+    format = request.args.get("format", "csv").lower()
+    formats = SPATIAL_FORMATS if geospatial else TABULAR_FORMATS
+    if format not in formats:
+        return tk.abort(400, tk._("format must be one of: ") + ", ".join(formats))
+
+    epsg_code = None
+    if geospatial:
+        epsg_code = request.args.get("projection", "4326")
+        if epsg_code not in EPSG_CODES:
+            return tk.abort(
+                400, tk._("projection must be one of: ") + ", ".join(EPSG_CODES)
+            )
+
+    if is_cache_fresh(resource):
+        cache_resource_id = _cached_file_id(resource, format, epsg_code)
+        if cache_resource_id:
+            response = _send_cached_file(cache_resource_id, format)
+            if response is not None:
+                return response
+
+    logging.info(
+        "[ckanext-opendatatoronto] --- No fresh {} cache of {}, converting".format(
+            format.upper(), resource_id
+        )
+    )
+    filename = "{}{}.{}".format(
+        resource["name"].replace(os.sep, "-"),
+        " - {}".format(epsg_code) if epsg_code else "",
+        "zip" if format == "shp" else format,
+    )
+
+    if geospatial:
+        return _convert_file(resource, format, epsg_code, filename)
+    return _stream_file(resource, format, filename)
@@ -0,0 +1,314 @@
+"""Streams datastore records out of postgres and into files
+
+Records are read with a server-side cursor, in batches, so memory use stays
+flat however big the datastore table is. Files are written a batch at a
+time too - CSV, JSON and XML come out like iotrans writes them, so they can
+stand in for to_file's non spatial files
+"""
+
+import ckan.plugins.toolkit as tk
+from ckanext.datastore.backend.postgres import get_read_engine, identifier
+import sqlalchemy as sa
+
+from datetime import date, datetime
+from decimal import Decimal
+
+from xml.sax.saxutils import escape, quoteattr
+
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+
+# formats we can stream, see stream()
+FORMATS = ["csv", "json", "xml"]
+
+# characters xml 1.0 doesnt allow anywhere in a document, even escaped
+XML_INVALID_CHARACTERS = re.compile(
+    "[^\u0009\u000a\u000d\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]"
+)
+
+
+def export_dir():
+    # where we write temporary export files
+    return tk.config.get("ckanext.opendata.export_dir") or tempfile.gettempdir()
+
+
+def batch_size():
+    # how many records we pull from postgres at a time
+    return tk.asint(tk.config.get("ckanext.opendata.export_batch_size", 10000))
+
+
+def table_columns(resource_id):
+    """Returns the column names of a datastore table, in table order"""
+
+    engine = get_read_engine()
+    with engine.connect() as connection:
+        result = connection.execute(
+            sa.text("SELECT * FROM {} LIMIT 0".format(identifier(resource_id)))
+        )
+        return [key for key in result.keys() if key != "_full_text"]
+
+
+def iter_records(resource_id, columns=None, after_id=None):
+    """Yields the records of a datastore table as dicts, in _id order
+
+    columns limits the output to those columns, in that order
+    after_id only returns records with an _id greater than it
+    """
+
+    select = (
+        ", ".join(identifier(column) for column in columns) if columns else "*"
+    )
+    where = ""
+    params = {}
+    if after_id is not None:
+        where = "WHERE _id > :after_id"
+        params["after_id"] = after_id
+
+    engine = get_read_engine()
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            sa.text(
+                "SELECT {select} FROM {table} {where} ORDER BY _id".format(
+                    select=select, table=identifier(resource_id), where=where
+                )
+            ),
+            **params
+        )
+        keys = [key for key in result.keys() if key != "_full_text"]
+
+        while True:
+            rows = result.fetchmany(batch_size())
+            if not rows:
+                break
+            for row in rows:
+                yield {key: row[key] for key in keys}
+
+
+def to_text(value):
+    """Renders a datastore value the way it appears in datastore_search"""
+
+    if value is None:
+        return ""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def json_default(value):
+    # json.dumps fallback for the postgres types it doesnt know
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def read_csv_headers(path):
+    """Returns the header row and the line terminator of a csv file"""
+
+    with open(path, "rb") as f:
+        first_line = f.readline()
+
+    line_terminator = "\r\n" if first_line.endswith(b"\r\n") else "\n"
+    headers = next(csv.reader([first_line.decode("utf-8-sig")]))
+
+    return headers, line_terminator
+
+
+def append_csv(path, records):
+    """Appends records to the end of an existing csv file
+
+    Columns are written in the order of the file's header row
+    Returns the number of records written
+    """
+
+    headers, line_terminator = read_csv_headers(path)
+    count = 0
+
+    # make sure we start on a fresh line
+    needs_newline = False
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        if needs_newline:
+            f.write(line_terminator)
+        writer = csv.writer(f, lineterminator=line_terminator)
+        for record in records:
+            writer.writerow([to_text(record.get(header)) for header in headers])
+            count += 1
+
+    return count
+
+
+def can_append_json(path):
+    """True if a file ends in a json array we can add records to"""
+
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 64))
+        return f.read().rstrip().endswith(b"]")
+
+
+def append_json(path, records):
+    """Adds records to the end of the json array in an existing file
+
+    The file isnt parsed - we find the closing bracket of the array, and
+    write the new records over it, followed by a new closing bracket
+    Returns the number of records written
+    """
+
+    count = 0
+
+    with open(path, "r+b") as f:
+        # find the closing bracket and whatever comes before it
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        f.seek(max(0, end - 64))
+        tail = f.read()
+        stripped_tail = tail.rstrip()
+        if not stripped_tail.endswith(b"]"):
+            raise ValueError("{} does not end in a json array".format(path))
+
+        bracket = end - len(tail) + len(stripped_tail) - 1
+        is_empty = stripped_tail[:-1].rstrip().endswith(b"[")
+
+        f.seek(bracket)
+        f.truncate()
+
+        for record in records:
+            if not is_empty or count > 0:
+                f.write(b", ")
+            f.write(json.dumps(record, default=json_default).encode("utf-8"))
+            count += 1
+
+        f.write(b"]")
+
+    return count
+
+
+def _batches(records):
+    # groups records, so writers put out one chunk per batch
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size():
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_csv(records, columns):
+    """Yields a csv file a chunk of text at a time - a header row of
+    columns, then one row per record"""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+
+    for batch in _batches(records):
+        for record in batch:
+            writer.writerow([to_text(record.get(column)) for column in columns])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    # the header row, if there were no records
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_json(records):
+    """Yields a json array of records a chunk of text at a time"""
+
+    yield "["
+    first = True
+    for batch in _batches(records):
+        chunk = ", ".join(json.dumps(record, default=json_default) for record in batch)
+        yield chunk if first else ", " + chunk
+        first = False
+    yield "]"
+
+
+def _xml_text(text):
+    return XML_INVALID_CHARACTERS.sub("", text)
+
+
+def _xml_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return escape(_xml_text(to_text(value)))
+
+
+def iter_xml(records):
+    """Yields an xml document of records a chunk of text at a time
+
+    Each record is a ROW element, numbered by its count attribute, with a
+    FIELD element per column. Column names go in the FIELD's name attribute,
+    as they are often not valid element names ("Ward Name", "2019 Count")
+    """
+
+    yield '<?xml version="1.0" encoding="utf-8"?><DATA>'
+    count = 0
+    for batch in _batches(records):
+        rows = []
+        for record in batch:
+            rows.append(
+                "<ROW count={}>{}</ROW>".format(
+                    quoteattr(str(count)),
+                    "".join(
+                        "<FIELD name={}>{}</FIELD>".format(
+                            quoteattr(_xml_text(key)), _xml_value(value)
+                        )
+                        for key, value in record.items()
+                    ),
+                )
+            )
+            count += 1
+        yield "".join(rows)
+    yield "</DATA>"
+
+
+def stream(resource_id, format, columns=None):
+    """Yields a whole datastore table in format (csv, json or xml), a chunk
+    of text at a time
+
+    columns limits the output to those columns, in that order
+    """
+
+    format = format.lower()
+    if format not in FORMATS:
+        raise ValueError("Cant stream {} files".format(format))
+
+    if columns is None:
+        columns = table_columns(resource_id)
+    records = iter_records(resource_id, columns)
+
+    if format == "csv":
+        return iter_csv(records, columns)
+    if format == "json":
+        return iter_json(records)
+    return iter_xml(records)
+
+
+def write_file(chunks, path):
+    """Writes chunks of text to a file
+    Returns the path"""
+
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+    return path
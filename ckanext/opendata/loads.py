@@ -0,0 +1,179 @@
+"""Bookkeeping for datastore loads that arrive over multiple datastore_create calls
+
+ETLs from NiFi send big datasets in "chunks". A load session groups those chunks
+under one load_id, so we can tell exactly when a load is finished (and cache it
+once), and keep some stats about each load afterwards.
+
+Sessions live in redis as hashes:
+    ckanext-opendata:<site_id>:load:<load_id>
+and the latest load ids of each resource are kept in a short list:
+    ckanext-opendata:<site_id>:load:resource:<resource_id>
+"""
+
+from ckan.lib.redis import connect_to_redis
+import ckan.plugins.toolkit as tk
+
+from . import utils
+from datetime import datetime
+
+import uuid
+
+# how many load ids we remember per resource
+RESOURCE_HISTORY_LENGTH = 20
+
+# integer fields of a session hash - everything else is returned as a string
+INT_FIELDS = ["records", "chunks"]
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _session_key(load_id):
+    return utils.redis_key("load", load_id)
+
+
+def _resource_key(resource_id):
+    return utils.redis_key("load", "resource", resource_id)
+
+
+def _open_ttl():
+    # unfinished sessions are dropped after this many seconds
+    return tk.asint(tk.config.get("ckanext.opendata.load_session_ttl", 86400))
+
+
+def _stats_ttl():
+    # finished sessions are kept around this long for their stats
+    return tk.asint(tk.config.get("ckanext.opendata.load_stats_ttl", 2592000))
+
+
+def _decode(session):
+    output = {k.decode("utf-8"): v.decode("utf-8") for k, v in session.items()}
+    for field in INT_FIELDS:
+        output[field] = int(output.get(field, 0))
+    return output
+
+
+def begin(resource_id=None, user=None, load_id=None):
+    """Opens a load session and returns it
+    resource_id can be left empty if the first chunk creates the resource"""
+
+    redis_conn = connect_to_redis()
+    load_id = load_id or str(uuid.uuid4())
+    key = _session_key(load_id)
+
+    pipe = redis_conn.pipeline()
+    pipe.hsetnx(key, "load_id", load_id)
+    pipe.hsetnx(key, "started", _now())
+    pipe.hsetnx(key, "status", "open")
+    pipe.hsetnx(key, "records", 0)
+    pipe.hsetnx(key, "chunks", 0)
+    if resource_id:
+        pipe.hsetnx(key, "resource_id", resource_id)
+    if user:
+        pipe.hsetnx(key, "user", user)
+    pipe.expire(key, _open_ttl())
+    pipe.execute()
+
+    return show(load_id)
+
+
+def show(load_id):
+    """Returns the session for the input load_id, or None if we dont know it"""
+
+    session = connect_to_redis().hgetall(_session_key(load_id))
+    if not session:
+        return None
+    return _decode(session)
+
+
+def history(resource_id):
+    """Returns the latest sessions for the input resource, newest first"""
+
+    load_ids = connect_to_redis().lrange(_resource_key(resource_id), 0, -1)
+    sessions = [show(load_id.decode("utf-8")) for load_id in load_ids]
+    return [session for session in sessions if session]
+
+
+def check_chunk(load_id, resource_id=None):
+    """Raises a ValidationError if a chunk for resource_id cant go into a
+    session - call it before writing the chunk, so a rejected chunk is
+    never stored. resource_id can be None if the chunk creates the resource
+    """
+
+    session = show(load_id)
+    if session is None:
+        return
+
+    if session.get("status") != "open":
+        raise tk.ValidationError(
+            {"constraints": ["Load {} has already been finalized".format(load_id)]}
+        )
+
+    if resource_id and session.get("resource_id", resource_id) != resource_id:
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Load {} belongs to resource {}, not {}".format(
+                        load_id, session["resource_id"], resource_id
+                    )
+                ]
+            }
+        )
+
+
+def record_chunk(load_id, resource_id, numrecords, user=None):
+    """Adds a chunk that was written to a session, opening the session if
+    needed. Check the chunk with check_chunk before writing it"""
+
+    show(load_id) or begin(resource_id, user, load_id)
+
+    redis_conn = connect_to_redis()
+    key = _session_key(load_id)
+    pipe = redis_conn.pipeline()
+    pipe.hsetnx(key, "resource_id", resource_id)
+    pipe.hincrby(key, "records", numrecords)
+    pipe.hincrby(key, "chunks", 1)
+    pipe.hset(key, "last_chunk", _now())
+    pipe.expire(key, _open_ttl())
+    pipe.execute()
+
+    return show(load_id)
+
+
+def finalize(load_id):
+    """Closes a load session
+
+    Returns the session, and whether this call is the one that closed it.
+    Only the closing call should trigger work like caching, so a load is
+    only ever acted on once, even if finalize is called more than once
+    """
+
+    redis_conn = connect_to_redis()
+    key = _session_key(load_id)
+
+    if not redis_conn.exists(key):
+        raise tk.ValidationError(
+            {"constraints": ["Unknown load_id {}".format(load_id)]}
+        )
+
+    # hsetnx is atomic, so only one caller can be the one that finalizes
+    closed_here = bool(redis_conn.hsetnx(key, "finalized", _now()))
+
+    if closed_here:
+        session = show(load_id)
+        started = utils.str_to_datetime(session["started"])
+        finalized = utils.str_to_datetime(session["finalized"])
+
+        pipe = redis_conn.pipeline()
+        pipe.hset(key, "status", "finalized")
+        pipe.hset(key, "duration", (finalized - started).total_seconds())
+        pipe.expire(key, _stats_ttl())
+        if session.get("resource_id"):
+            resource_key = _resource_key(session["resource_id"])
+            pipe.lpush(resource_key, load_id)
+            pipe.ltrim(resource_key, 0, RESOURCE_HISTORY_LENGTH - 1)
+            pipe.expire(resource_key, _stats_ttl())
+        pipe.execute()
+
+    return show(load_id), closed_here
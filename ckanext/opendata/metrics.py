@@ -0,0 +1,301 @@
+"""Call counts, latencies and errors of this extension's actions and hooks
+
+Every instrumented call is recorded in this process' memory: a counter,
+a latency histogram, an error counter, and how many other instrumented
+calls it made while it ran ("nested" calls). That's a few dict updates per
+call - nothing touches redis on the way.
+
+Every few seconds, the next call to finish flushes this process' numbers
+into redis, where the numbers of every CKAN process add up:
+    ckanext-opendata:<site_id>:metrics:<name>
+The opendata_metrics action reads them back, and if
+ckanext.opendata.metrics_file is set, they're also written there in the
+prometheus text format after each flush, for a node exporter to pick up.
+
+RunReport is for the other question - where did the time of one long run
+(like a datastore_cache run) go - and is kept with whatever was run.
+"""
+
+from ckan.lib.redis import connect_to_redis
+import ckan.plugins.toolkit as tk
+
+from . import utils
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+# this process' numbers since its last flush, by metric name
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = [time.time()]
+
+# what's running on each thread, so we can count nested calls
+_local = threading.local()
+
+
+def _flush_interval():
+    return tk.asint(tk.config.get("ckanext.opendata.metrics_flush_interval", 10))
+
+
+def _names_key():
+    return utils.redis_key("metrics", "names")
+
+
+def _metric_key(name):
+    return utils.redis_key("metrics", name)
+
+
+def _new_entry():
+    return {"calls": 0, "errors": 0, "seconds": 0.0, "nested": 0,
+            "buckets": [0] * (len(BUCKETS) + 1)}
+
+
+def record(name, seconds, error=False, nested=0):
+    """Adds one call to a metric"""
+
+    with _pending_lock:
+        entry = _pending.get(name)
+        if entry is None:
+            entry = _pending[name] = _new_entry()
+        entry["calls"] += 1
+        entry["seconds"] += seconds
+        entry["nested"] += nested
+        entry["buckets"][bisect_left(BUCKETS, seconds)] += 1
+        if error:
+            entry["errors"] += 1
+
+    if time.time() - _last_flush[0] > _flush_interval():
+        flush()
+
+
+def timed(name):
+    """Decorator that records every call of a function under name
+
+    Works on actions, chained actions and plugin hooks alike - attributes
+    CKAN looks for, like side_effect_free or chained_action, are kept
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            stack = getattr(_local, "stack", None)
+            if stack is None:
+                stack = _local.stack = []
+            if stack:
+                stack[-1]["nested"] += 1
+
+            call = {"nested": 0}
+            stack.append(call)
+            error = False
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                stack.pop()
+                record(name, time.perf_counter() - start, error, call["nested"])
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_actions(actions):
+    # wraps each action of an IActions dict, recorded as "action:<name>"
+    return {
+        name: timed("action:" + name)(action) for name, action in actions.items()
+    }
+
+
+def flush():
+    """Adds this process' numbers to the shared ones in redis"""
+
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+
+    if not pending:
+        return
+
+    try:
+        pipe = connect_to_redis().pipeline()
+        for name, entry in pending.items():
+            key = _metric_key(name)
+            pipe.sadd(_names_key(), name)
+            pipe.hincrby(key, "calls", entry["calls"])
+            pipe.hincrby(key, "errors", entry["errors"])
+            pipe.hincrby(key, "nested", entry["nested"])
+            pipe.hincrbyfloat(key, "seconds", entry["seconds"])
+            for bound, count in zip(BUCKETS + ["+Inf"], entry["buckets"]):
+                if count:
+                    pipe.hincrby(key, "bucket:{}".format(bound), count)
+        pipe.execute()
+    except Exception as e:
+        # metrics should never break the call they're measuring
+        logging.error("[ckanext-opendatatoronto] --- Couldnt flush metrics: " + str(e))
+        return
+
+    path = tk.config.get("ckanext.opendata.metrics_file")
+    if path:
+        try:
+            _write_file(path, prometheus_text(read()))
+        except Exception as e:
+            logging.error(
+                "[ckanext-opendatatoronto] --- Couldnt write metrics file: " + str(e)
+            )
+
+
+def read():
+    """Returns every process' flushed numbers, by metric name
+
+    Each metric has its calls, errors, total seconds, nested calls, and a
+    cumulative latency histogram, as {upper bound: calls at most that long}
+    """
+
+    redis_conn = connect_to_redis()
+    names = sorted(name.decode("utf-8") for name in redis_conn.smembers(_names_key()))
+
+    pipe = redis_conn.pipeline()
+    for name in names:
+        pipe.hgetall(_metric_key(name))
+
+    output = {}
+    for name, values in zip(names, pipe.execute()):
+        values = {k.decode("utf-8"): v.decode("utf-8") for k, v in values.items()}
+        histogram = {}
+        cumulative = 0
+        for bound in BUCKETS + ["+Inf"]:
+            cumulative += int(values.get("bucket:{}".format(bound), 0))
+            histogram[str(bound)] = cumulative
+
+        output[name] = {
+            "calls": int(values.get("calls", 0)),
+            "errors": int(values.get("errors", 0)),
+            "nested": int(values.get("nested", 0)),
+            "seconds": float(values.get("seconds", 0)),
+            "histogram": histogram,
+        }
+
+    return output
+
+
+def reset():
+    # forgets every process' flushed numbers
+    redis_conn = connect_to_redis()
+    names = [name.decode("utf-8") for name in redis_conn.smembers(_names_key())]
+    redis_conn.delete(_names_key(), *[_metric_key(name) for name in names])
+
+
+def prometheus_text(metrics):
+    """Renders read() in the prometheus text exposition format"""
+
+    families = [
+        ("opendata_calls_total", "counter", "calls"),
+        ("opendata_errors_total", "counter", "errors"),
+        ("opendata_nested_calls_total", "counter", "nested"),
+    ]
+
+    def labels(name):
+        kind, _, label = name.partition(":")
+        return 'kind="{}",name="{}"'.format(kind, label)
+
+    # each family's lines have to be grouped together
+    lines = []
+    for family, kind, field in families:
+        lines.append("# TYPE {} {}".format(family, kind))
+        for name, metric in sorted(metrics.items()):
+            lines.append("{}{{{}}} {}".format(family, labels(name), metric[field]))
+
+    lines.append("# TYPE opendata_call_seconds histogram")
+    for name, metric in sorted(metrics.items()):
+        for bound, count in metric["histogram"].items():
+            lines.append(
+                'opendata_call_seconds_bucket{{{},le="{}"}} {}'.format(
+                    labels(name), bound, count
+                )
+            )
+        lines.append(
+            "opendata_call_seconds_sum{{{}}} {}".format(labels(name), metric["seconds"])
+        )
+        lines.append(
+            "opendata_call_seconds_count{{{}}} {}".format(labels(name), metric["calls"])
+        )
+
+    return "\n".join(lines) + "\n"
+
+
+def _write_file(path, text):
+    # write next to the target and move it into place, so a scraper never
+    # reads half a file
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, "w") as f:
+        f.write(text)
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
+
+
+class RunReport(object):
+    """Stage by stage timings of one run of a long action
+
+    Each stage is a dict with its name, its duration in seconds, and any
+    details the caller adds to it (bytes written, rows, formats...).
+    Stages can be timed from several threads at once.
+    on_stage, if given, is called with each stage's name as it starts
+    """
+
+    def __init__(self, on_stage=None):
+        self.started = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+        self.stages = []
+        self.details = {}
+        self.on_stage = on_stage
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, **details):
+        span = dict(details, stage=name)
+        self.stages.append(span)
+        if self.on_stage is not None:
+            self.on_stage(name)
+
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span["error"] = str(e)
+            raise
+        finally:
+            span["seconds"] = round(time.perf_counter() - start, 3)
+
+    def summary(self):
+        """Returns the run so far: when it started, how long it's taken,
+        its details, its stages, and the total seconds spent in each kind
+        of stage"""
+
+        totals = {}
+        for span in self.stages:
+            totals[span["stage"]] = round(
+                totals.get(span["stage"], 0) + span.get("seconds", 0), 3
+            )
+
+        return dict(
+            self.details,
+            started=self.started,
+            seconds=round(time.perf_counter() - self._start, 3),
+            stage_seconds=totals,
+            stages=list(self.stages),
+        )
@@ -1,5 +1,6 @@
-from . import api, schema, utils
+from . import api, cache, cli, download, metrics, schema, utils
 
+import ckan.model as model
 import ckan.plugins as p
 import ckan.plugins.toolkit as tk
 from ckan.plugins.toolkit import _
@@ -7,6 +8,10 @@ from ckan.plugins.toolkit import _
 
 class ExtendedAPIPlugin(p.SingletonPlugin):
     p.implements(p.IActions)
+    p.implements(p.IConfigurable)
+    p.implements(p.IDomainObjectModification, inherit=True)
+    p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IClick)
 
     # ==============================
     # IActions
@@ -16,16 +21,68 @@ class ExtendedAPIPlugin(p.SingletonPlugin):
     # api.extract_info function
     # These can also be used with tk.get_action("extract_info"), for example,
     # in this CKAN extension code
+    # Every action is timed and counted, see metrics.py
 
     def get_actions(self):
-        return {
+        return metrics.instrument_actions({
             "quality_show": api.quality_show,
+            "quality_show_bulk": api.quality_show_bulk,
             "search_packages": api.query_packages,
             "search_facet": api.query_facet,
+            "search_cache_stats": api.search_cache_stats,
             "datastore_cache": api.datastore_cache,
+            "datastore_cache_status": api.datastore_cache_status,
+            "resource_bulk_upsert": api.resource_bulk_upsert,
             "datastore_create": api.datastore_create_hook,
+            "datastore_delete": api.datastore_delete_hook,
+            "datastore_upsert": api.datastore_upsert_hook,
+            "datastore_load_begin": api.datastore_load_begin,
+            "datastore_load_finalize": api.datastore_load_finalize,
+            "datastore_load_show": api.datastore_load_show,
             "reindex_solr": api.reindex_solr,
-        }
+            "reindex_solr_status": api.reindex_solr_status,
+            "resource_views_backfill": api.resource_views_backfill,
+            "resource_views_backfill_status": api.resource_views_backfill_status,
+            "opendata_metrics": api.opendata_metrics,
+            "opendata_metrics_reset": api.opendata_metrics_reset,
+        })
+
+    # ==============================
+    # IClick
+    # ==============================
+    # Adds the "ckan opendata" commands, see cli.py
+
+    def get_commands(self):
+        return cli.get_commands()
+
+    # ==============================
+    # IConfigurable
+    # ==============================
+
+    def configure(self, config):
+        api.listen_for_commits()
+
+    # ==============================
+    # IDomainObjectModification
+    # ==============================
+    # Called for every package that's created, updated or deleted - including
+    # the formats / last_refreshed writes in schema.update_package - so cached
+    # search results and metadata-catalog lookups never outlive a change for long
+    # This runs before the change is committed and indexed, so they're retired
+    # once the transaction commits, see api.package_changed
+
+    def notify(self, entity, operation):
+        if isinstance(entity, model.Package):
+            api.package_changed(entity.name)
+
+    # ==============================
+    # IPackageController
+    # ==============================
+    # Indexes n-gram copies of the fields search_packages and search_facet
+    # look for words in, so build_query can use term queries on them
+
+    def before_index(self, pkg_dict):
+        return utils.add_ngram_fields(pkg_dict)
 
 
 class UpdateSchemaPlugin(p.SingletonPlugin):
@@ -59,43 +116,48 @@ class UpdateSchemaPlugin(p.SingletonPlugin):
     #   updates a package's formats and last_refreshed date based on changes
     #   to its resources
 
+    # each hook is timed and counted, see metrics.py
+
+    @metrics.timed("hook:before_create")
     def before_create(self, context, resource):
-        package = tk.get_action("package_show")(context, {
-            "id": resource["package_id"]
-        })
+        package = cache.cached_action(
+            context, "package_show", {"id": resource["package_id"]}
+        )
+        schema.prepare_resource(package, resource)
 
-        # throw an error if we attempt to create 2 packages with the same name
-        for idx, r in enumerate(package["resources"]):
-            if r["name"] == resource["name"]:
-                raise tk.ValidationError(
-                    {
-                        "constraints": [
-                            "A resource with the name {name} already exists \
-                            for this package".format(
-                                name=r["name"]
-                            )
-                        ]
-                    }
-                )
-
-        # auto assign a format, if the format isnt assigned yet
-        if not ("format" in resource and resource["format"]):
-            resource["format"] = resource["url"].split(".")[-1]
-
-        resource["format"] = resource["format"].upper()
+    # the package just changed, so anything we cached about it is stale
 
+    @metrics.timed("hook:after_create")
     def after_create(self, context, resource):
+        cache.invalidate_package(context, resource["package_id"])
         schema.create_resource_views(context, resource)
         schema.update_package(context)
 
+    @metrics.timed("hook:after_update")
     def after_update(self, context, resource):
+        cache.invalidate_package(context, resource["package_id"])
         schema.create_resource_views(context, resource)
         schema.update_package(context)
 
+    @metrics.timed("hook:after_delete")
     def after_delete(self, context, resources):
+        cache.invalidate_package(context, context["package"].id)
         schema.update_package(context)
 
 
+class ExtendedURLPlugin(p.SingletonPlugin):
+    p.implements(p.IBlueprint)
+
+    # ==============================
+    # IBlueprint
+    # ==============================
+    # These are custom URLs outside the action API
+    # ex: <ckan_url>/download_resource/<resource_id>, see download.py
+
+    def get_blueprint(self):
+        return download.download
+
+
 class ExtendedThemePlugin(p.SingletonPlugin):
     """Logic to manage custom themes and previews"""
 
@@ -0,0 +1,276 @@
+"""Rebuilds the solr index in the background, a batch of packages at a time
+
+reindex_solr picks the packages to reindex, splits them into batches, and
+puts one job per batch on the job queue, so batches run in parallel across
+however many workers are listening to that queue.
+
+Each run's progress lives in redis as a hash:
+    ckanext-opendata:<site_id>:reindex:<run_id>
+with its latest errors in a short list:
+    ckanext-opendata:<site_id>:reindex:<run_id>:errors
+A run is "running" until its last batch is done, then "finished" - or
+"failed", as soon as any of its batches breaks off
+"""
+
+from ckan.lib import jobs, search
+from ckan.lib.redis import connect_to_redis
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+
+from . import utils
+from datetime import datetime
+
+import json
+import logging
+import uuid
+
+# how many errors we keep the details of, per run
+ERROR_HISTORY_LENGTH = 100
+
+# integer fields of a run hash - everything else is returned as a string
+INT_FIELDS = [
+    "total", "processed", "errors", "batches", "batches_done", "failed_batches",
+]
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _run_key(run_id):
+    return utils.redis_key("reindex", run_id)
+
+
+def _errors_key(run_id):
+    return utils.redis_key("reindex", run_id, "errors")
+
+
+def _latest_key():
+    return utils.redis_key("reindex", "latest")
+
+
+def _ttl():
+    # runs are kept around this long for their stats
+    return tk.asint(tk.config.get("ckanext.opendata.reindex_stats_ttl", 604800))
+
+
+def package_ids(since=None, organization=None, ids=None):
+    """Returns the ids of the packages a reindex should cover
+
+    since only keeps packages modified at or after that datetime
+    organization only keeps packages of that organization (id or name)
+    ids only keeps those packages (ids or names)
+    With no inputs, every package that isnt deleted is returned, like
+    `ckan search-index rebuild -r` does
+    """
+
+    query = model.Session.query(model.Package.id).filter(
+        model.Package.state != "deleted"
+    )
+
+    if since is not None:
+        query = query.filter(model.Package.metadata_modified >= since)
+
+    if organization:
+        group = model.Group.get(organization)
+        if group is None:
+            raise tk.ValidationError(
+                {"constraints": ["Unknown organization {}".format(organization)]}
+            )
+        query = query.filter(model.Package.owner_org == group.id)
+
+    if ids:
+        query = query.filter(
+            model.Package.id.in_(ids) | model.Package.name.in_(ids)
+        )
+
+    return [row[0] for row in query.order_by(model.Package.id)]
+
+
+def start(ids, user, batch_size, commit_interval):
+    """Opens a run for the input package ids and queues its batches
+    Returns the run, as reindex_solr_status shows it"""
+
+    redis_conn = connect_to_redis()
+    run_id = str(uuid.uuid4())
+    key = _run_key(run_id)
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+    pipe = redis_conn.pipeline()
+    pipe.hset(key, "run_id", run_id)
+    pipe.hset(key, "user", user or "")
+    pipe.hset(key, "started", _now())
+    pipe.hset(key, "status", "running" if batches else "finished")
+    pipe.hset(key, "total", len(ids))
+    pipe.hset(key, "processed", 0)
+    pipe.hset(key, "errors", 0)
+    pipe.hset(key, "batches", len(batches))
+    pipe.hset(key, "batches_done", 0)
+    pipe.hset(key, "failed_batches", 0)
+    pipe.hset(key, "commit_interval", commit_interval)
+    if not batches:
+        pipe.hset(key, "finished", _now())
+    pipe.expire(key, _ttl())
+    pipe.set(_latest_key(), run_id, ex=_ttl())
+    pipe.execute()
+
+    queue_name = tk.config.get(
+        "ckanext.opendata.reindex_queue", jobs.DEFAULT_QUEUE_NAME
+    )
+    for number, batch in enumerate(batches):
+        tk.enqueue_job(
+            reindex_batch_job,
+            args=[run_id, batch],
+            title="reindex_solr - {} - batch {}".format(run_id, number),
+            queue=queue_name,
+        )
+
+    logging.info(
+        "[ckanext-opendatatoronto] --- Queued reindex {}: {} packages in {} batches".format(
+            run_id, len(ids), len(batches)
+        )
+    )
+
+    return show(run_id)
+
+
+def show(run_id=None):
+    """Returns a run's progress, or None if we dont know it
+    Without a run_id, the latest run is returned"""
+
+    redis_conn = connect_to_redis()
+
+    if run_id is None:
+        run_id = redis_conn.get(_latest_key())
+        if run_id is None:
+            return None
+        run_id = run_id.decode("utf-8")
+
+    run = redis_conn.hgetall(_run_key(run_id))
+    if not run:
+        return None
+
+    output = {k.decode("utf-8"): v.decode("utf-8") for k, v in run.items()}
+    for field in INT_FIELDS:
+        output[field] = int(output.get(field, 0))
+    output["remaining"] = output["total"] - output["processed"] - output["errors"]
+    output["latest_errors"] = [
+        json.loads(error)
+        for error in redis_conn.lrange(_errors_key(run_id), 0, -1)
+    ]
+
+    return output
+
+
+def _count_batch(run_id, processed, errors):
+    """Adds a batch's packages to its run's counts
+    Returns whether it was the run's last batch, and whether the run's
+    processed count crossed a multiple of its commit_interval"""
+
+    key = _run_key(run_id)
+    pipe = connect_to_redis().pipeline()
+    pipe.hincrby(key, "processed", processed)
+    pipe.hincrby(key, "errors", len(errors))
+    pipe.hincrby(key, "batches_done", 1)
+    for error in errors:
+        pipe.lpush(_errors_key(run_id), json.dumps(error))
+    pipe.ltrim(_errors_key(run_id), 0, ERROR_HISTORY_LENGTH - 1)
+    pipe.expire(_errors_key(run_id), _ttl())
+    pipe.hget(key, "commit_interval")
+    pipe.hget(key, "batches")
+    total_processed, _, batches_done, *_, commit_interval, batches = pipe.execute()
+
+    commit_interval = int(commit_interval or 1)
+    is_last = batches_done >= int(batches or 0)
+    crossed_interval = (
+        total_processed // commit_interval
+        > (total_processed - processed) // commit_interval
+    )
+    return is_last, crossed_interval
+
+
+def _batch_failed(run_id, error):
+    # a batch broke off - the run has failed, whatever the other batches do
+    key = _run_key(run_id)
+    pipe = connect_to_redis().pipeline()
+    pipe.hset(key, "status", "failed")
+    pipe.hset(key, "error", str(error))
+    pipe.hincrby(key, "failed_batches", 1)
+    pipe.execute()
+
+
+def _run_finished(run_id):
+    # the run's last batch is done - it stays failed if any batch broke off
+    redis_conn = connect_to_redis()
+    key = _run_key(run_id)
+    pipe = redis_conn.pipeline()
+    if not int(redis_conn.hget(key, "failed_batches") or 0):
+        pipe.hset(key, "status", "finished")
+    pipe.hset(key, "finished", _now())
+    pipe.execute()
+    logging.info("[ckanext-opendatatoronto] --- Finished reindex " + run_id)
+
+
+def reindex_batch_job(run_id, ids):
+    """Indexes a batch of packages, from a background worker
+
+    Solr is only committed to when the run's processed count crosses a
+    multiple of its commit_interval, or when this is the run's last batch
+
+    A batch that breaks off still counts towards its run - the packages it
+    didnt get to count as errors, and the run is marked failed - so the
+    run's last batch always ends it
+    """
+
+    processed = 0
+    errors = []
+    is_last = False
+    try:
+        try:
+            package_index = search.index_for(model.Package)
+            for package_id in ids:
+                context = {
+                    "model": model,
+                    "ignore_auth": True,
+                    "validate": False,
+                    "use_cache": False,
+                }
+                try:
+                    package_index.update_dict(
+                        tk.get_action("package_show")(context, {"id": package_id}),
+                        defer_commit=True,
+                    )
+                    processed += 1
+                except Exception as e:
+                    logging.error(
+                        "[ckanext-opendatatoronto] --- Reindex {} failed for {}: {}".format(
+                            run_id, package_id, e
+                        )
+                    )
+                    errors.append(
+                        {"package_id": package_id, "error": str(e), "at": _now()}
+                    )
+                    # dont leave a failed transaction for the next package
+                    model.Session.rollback()
+        except Exception as e:
+            error = "Batch broke off: {}".format(e)
+            errors += [
+                {"package_id": package_id, "error": error, "at": _now()}
+                for package_id in ids[processed + len(errors):]
+            ]
+            raise
+        finally:
+            model.Session.remove()
+            is_last, crossed_interval = _count_batch(run_id, processed, errors)
+
+        if is_last or crossed_interval:
+            search.commit()
+    except Exception as e:
+        logging.error(
+            "[ckanext-opendatatoronto] --- Reindex {} batch failed: {}".format(run_id, e)
+        )
+        _batch_failed(run_id, e)
+        raise
+    finally:
+        if is_last:
+            _run_finished(run_id)
@@ -1,11 +1,47 @@
+import ckan.lib.plugins as lib_plugins
+import ckan.model as model
 import ckan.plugins.toolkit as tk
+import sqlalchemy as sa
 
+from . import cache, utils
+from datetime import datetime
 
-def create_resource_views(context, resource):
-    # creates the views for resources to be viewed in the CKAN UI
-    format_views = {
-        "map": {
-            "resource_id": resource["id"],
+
+def check_resource_name(package, resource):
+    # throw an error if another resource of the package has the same name
+    for r in package["resources"]:
+        if r["name"] == resource["name"] and r.get("id") != resource.get("id"):
+            raise tk.ValidationError(
+                {
+                    "constraints": [
+                        "A resource with the name {name} already exists \
+                        for this package".format(
+                            name=r["name"]
+                        )
+                    ]
+                }
+            )
+
+
+def normalize_format(resource):
+    # auto assign a format, if the format isnt assigned yet
+    if not ("format" in resource and resource["format"]):
+        resource["format"] = resource["url"].split(".")[-1]
+
+    resource["format"] = resource["format"].upper()
+
+
+def prepare_resource(package, resource):
+    # checks and fills in a resource that's about to be added to a package
+    check_resource_name(package, resource)
+    normalize_format(resource)
+
+
+def view_definitions(resource_id):
+    # the views we make for resources, by view type
+    return {
+        "recline_map_view": {
+            "resource_id": resource_id,
             "title": "Map",
             "view_type": "recline_map_view",
             "auto_zoom": True,
@@ -13,18 +49,23 @@ def create_resource_views(context, resource):
             "map_field_type": "geojson",
             "limit": 500,
         },
-        "data explorer": {
-            "resource_id": resource["id"],
+        "recline_view": {
+            "resource_id": resource_id,
             "title": "Data Explorer",
             "view_type": "recline_view",
         },
-        "dqs": {
-            "resource_id": resource["id"],
+        "dqs_view": {
+            "resource_id": resource_id,
             "title": "DQS",
             "view_type": "dqs_view",
         },
     }
 
+
+def create_resource_views(context, resource):
+    # creates the views for resources to be viewed in the CKAN UI
+    format_views = view_definitions(resource["id"])
+
     # we dont make views for datastore_cache resources
     if resource.get("is_datastore_cache_file", False) in [True, "True", "true"]:
         return
@@ -37,7 +78,7 @@ def create_resource_views(context, resource):
 
     # make DQS views for any resource
     if "dqs_view" not in existing_view_types:
-        tk.get_action("resource_view_create")(context, format_views["dqs"])
+        tk.get_action("resource_view_create")(context, format_views["dqs_view"])
 
     # only make "preview" views for datastore resources
     # those require datastore resources, so if not datasore, we stop here
@@ -46,68 +87,108 @@ def create_resource_views(context, resource):
 
     # make a data explorer view for all resources
     if "recline_view" not in existing_view_types:
-        tk.get_action("resource_view_create")(context, format_views["data explorer"])
+        tk.get_action("resource_view_create")(context, format_views["recline_view"])
 
     # make a map view for a resource with a 'geometry' field
     if (
-        "geometry"
-        in [
-            field["id"]
-            for field in tk.get_action("datastore_search")(
-                context, {"id": resource["id"], "limit": 0}
-            )["fields"]
-        ]
-        and "recline_map_view" not in existing_view_types
+        "recline_map_view" not in existing_view_types
+        and utils.is_geospatial(resource["id"], context)
     ):
-        tk.get_action("resource_view_create")(context, format_views["map"])
+        tk.get_action("resource_view_create")(context, format_views["recline_map_view"])
+
+
+def validate_package_fields(context, package, values):
+    """Returns package field values the way package_update would save them,
+    after the package schema's validators (choices_to_string,
+    default_to_today, ...) have run on them
+
+    Only the validators of these fields run for real - errors other fields
+    get for being left out are ignored
+    """
+
+    package_plugin = lib_plugins.lookup_package_plugin(package.type)
+    data, errors = lib_plugins.plugin_validate(
+        package_plugin,
+        dict(context, package=package),
+        dict(values, id=package.id, name=package.name, type=package.type),
+        package_plugin.update_package_schema(),
+        "package_update",
+    )
+
+    errors = {k: v for k, v in errors.items() if k in values}
+    if errors:
+        raise tk.ValidationError(errors)
+
+    # fields that arent core package fields are saved as extras
+    extras = {e["key"]: e["value"] for e in data.get("extras", [])}
+    return {k: extras.get(k, data.get(k)) for k in values}
 
 
 def update_package(context):
     # Ensures that changes to a resource in a package also affect the
     # package's metadata
     package = context["package"]
-    resources = [r for r in package.resources_all if r.state == "active"]
-
-    formats = set()
-    last_refreshed = []
-
-    for r in resources:
-        resource_format = r.format.upper()
-
-        # add all resource formats to the package's list of formats
-        formats.add(resource_format)
 
-        # add possible last refreshed dates to array, to be sorted
-        # through below
-        last_refreshed.append(r.created if r.last_modified is None else r.last_modified)
+    # get the package's formats and latest resource change in one query,
+    # instead of loading every resource
+    formats, last_refreshed = (
+        model.Session.query(
+            sa.func.array_agg(sa.distinct(sa.func.upper(model.Resource.format))),
+            sa.func.max(
+                sa.func.coalesce(model.Resource.last_modified, model.Resource.created)
+            ),
+        )
+        .filter(model.Resource.package_id == package.id)
+        .filter(model.Resource.state == "active")
+        .one()
+    )
 
-    formats = ",".join(list(formats)) if len(formats) else None
+    # add all resource formats to the package's list of formats
+    formats = sorted(f for f in (formats or []) if f)
+    formats = ",".join(formats) if len(formats) else None
 
     # make sure the package's last refreshed date is the latest last refreshed
     # date of its resources
     last_refreshed = (
-        max(last_refreshed).strftime("%Y-%m-%dT%H:%M:%S.%f")
-        if len(last_refreshed)
+        last_refreshed.strftime("%Y-%m-%dT%H:%M:%S.%f")
+        if last_refreshed is not None
         else None
     )
 
-    # If the last refreshed date isnt what it already is in the CKAN package,
+    # If these arent what they already are in the CKAN package,
     # update the package
-    if (
-        "last_refreshed"
-        in tk.get_action("package_show")(context, {"id": package.id}).keys()
-    ):
-        old_last_refreshed = tk.get_action("package_show")(context, {"id": package.id})[
-            "last_refreshed"
-        ]
-    else:
-        old_last_refreshed = None
-
-    if last_refreshed != old_last_refreshed:
-        tk.get_action("package_patch")(
-            context,
-            {
-                "id": package.id,
-                "last_refreshed": last_refreshed,
-                "formats": formats},
-        )
+    new_values = {"last_refreshed": last_refreshed, "formats": formats}
+    changed = {k: v for k, v in new_values.items() if package.extras.get(k) != v}
+
+    # values that are set go through the validators package_patch used to
+    # run them through, and are compared in that shape - stored ones too, as
+    # they're saved after validation (a last_refreshed comes back as a date)
+    to_validate = {k: v for k, v in changed.items() if v is not None}
+    if to_validate:
+        new_values = validate_package_fields(context, package, to_validate)
+        old_values = {k: package.extras[k] for k in to_validate if k in package.extras}
+        if old_values:
+            old_values = validate_package_fields(context, package, old_values)
+        changed.update(new_values)
+        for key, value in new_values.items():
+            if key in old_values and old_values[key] == value:
+                changed.pop(key)
+
+    if not changed:
+        return
+
+    # we only write the changed extras, instead of a package_patch
+    # re-validating and re-saving the whole package
+    for key, value in changed.items():
+        if value is None:
+            package.extras.pop(key, None)
+        else:
+            package.extras[key] = value
+    package.metadata_modified = datetime.utcnow()
+
+    # committing a changed package reindexes it in solr, once
+    # if our caller is batching changes, their commit will do it
+    if not context.get("defer_commit"):
+        model.repo.commit()
+
+    cache.invalidate_package(context, package.id)
@@ -0,0 +1,293 @@
+"""Where each resource's datastore cache build is at
+
+A resource's build is queued while its job waits on the job queue - we know
+that from the resource's "pending" slot, and the job itself. The slot holds
+the id of the job waiting for the resource (and when it was claimed), from
+when enqueue_datastore_cache claims it until the job starts running:
+    ckanext-opendata:<site_id>:datastore_cache:pending:<resource_id>
+It's only ever changed with compare-and-set scripts, so two callers cant
+both claim it.
+
+Once a worker picks it up, datastore_cache keeps the build's progress in a
+hash, until the next build replaces it:
+    ckanext-opendata:<site_id>:datastore_cache:status:<resource_id>
+How long the latest builds took is kept in a short list, for the average
+and worst time per job:
+    ckanext-opendata:<site_id>:datastore_cache:durations
+"""
+
+from ckan.lib import jobs
+from ckan.lib.redis import connect_to_redis
+import ckan.plugins.toolkit as tk
+from rq.registry import StartedJobRegistry
+
+from . import utils
+from datetime import datetime
+
+import json
+import time
+
+# how many builds we keep the duration of
+DURATION_HISTORY_LENGTH = 100
+
+# prefix of the ids of datastore_cache jobs, see enqueue_datastore_cache
+JOB_ID_PREFIX = "datastore_cache-"
+
+# a claimed slot whose job isnt on the queue yet is still being enqueued
+# for this many seconds - after that, the job is taken to be gone
+CLAIM_GRACE_SECONDS = 60
+
+# sets the pending slot to ARGV[2], if it's still ARGV[1] ("" for empty)
+CLAIM_SCRIPT = """
+local current = redis.call('GET', KEYS[1]) or ''
+if current == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# empties the pending slot, if it's held by the job ARGV[1]
+RELEASE_SCRIPT = """
+local current = redis.call('GET', KEYS[1]) or ''
+if string.sub(current, 1, string.len(ARGV[1]) + 1) == ARGV[1] .. '|' then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _status_key(resource_id):
+    return utils.redis_key("datastore_cache", "status", resource_id)
+
+
+def _pending_key(resource_id):
+    return utils.redis_key("datastore_cache", "pending", resource_id)
+
+
+def _durations_key():
+    return utils.redis_key("datastore_cache", "durations")
+
+
+def _ttl():
+    # a finished build's status is kept around this long
+    return tk.asint(
+        tk.config.get("ckanext.opendata.datastore_cache_status_ttl", 604800)
+    )
+
+
+def queue_name():
+    return tk.config.get(
+        "ckanext.opendata.datastore_cache_queue", jobs.DEFAULT_QUEUE_NAME
+    )
+
+
+def pending(resource_id):
+    """Returns the pending slot of a resource, as (raw value, job id, when
+    it was claimed), or ("", None, None) if it's empty"""
+
+    value = connect_to_redis().get(_pending_key(resource_id))
+    if not value:
+        return "", None, None
+
+    value = value.decode("utf-8")
+    job_id, _, claimed_at = value.rpartition("|")
+    # slots from before claims were timed only hold the job id
+    if not job_id:
+        return value, value, 0.0
+    return value, job_id, float(claimed_at)
+
+
+def claim_pending(resource_id, job_id, expected):
+    """Puts job_id in a resource's pending slot, if the slot still holds
+    expected (a raw value from pending()). True if it did"""
+
+    claim = connect_to_redis().register_script(CLAIM_SCRIPT)
+    value = "{}|{}".format(job_id, time.time())
+    return bool(claim(keys=[_pending_key(resource_id)], args=[expected, value]))
+
+
+def release_pending(resource_id, job_id):
+    # empties a resource's pending slot, if job_id still holds it
+    release = connect_to_redis().register_script(RELEASE_SCRIPT)
+    release(keys=[_pending_key(resource_id)], args=[job_id])
+
+
+def waiting_job(resource_id, queue=None):
+    """Returns whether a resource's pending slot is held by a job that's
+    waiting (or about to be) on the queue, and that job if it's there"""
+
+    _, job_id, claimed_at = pending(resource_id)
+    if job_id is None:
+        return False, None
+
+    queue = queue or jobs.get_queue(queue_name())
+    job = queue.fetch_job(job_id)
+    if job is None:
+        return time.time() - claimed_at < CLAIM_GRACE_SECONDS, None
+    return job.get_status() == "queued", job
+
+
+def started(resource_id, job_id=None):
+    # a worker started building this resource's cache
+    key = _status_key(resource_id)
+    pipe = connect_to_redis().pipeline()
+    pipe.delete(key)
+    pipe.hset(key, "state", "running")
+    pipe.hset(key, "job_id", job_id or "")
+    pipe.hset(key, "started", _now())
+    pipe.expire(key, _ttl())
+    pipe.execute()
+
+
+def set_stage(resource_id, stage):
+    # called as each stage of a build starts, see metrics.RunReport
+    key = _status_key(resource_id)
+    pipe = connect_to_redis().pipeline()
+    pipe.hset(key, "stage", stage)
+    pipe.hset(key, "stage_started", _now())
+    pipe.execute()
+
+
+def finished(resource_id, report):
+    """Marks a build as done, with its report
+
+    Builds that were skipped because the data hadnt changed dont count
+    towards the time per job
+    """
+
+    key = _status_key(resource_id)
+    pipe = connect_to_redis().pipeline()
+    pipe.hset(key, "state", "finished")
+    pipe.hset(key, "finished", _now())
+    pipe.hset(key, "seconds", report["seconds"])
+    pipe.hset(key, "report", json.dumps(report))
+    pipe.hdel(key, "stage", "stage_started")
+    pipe.expire(key, _ttl())
+    if report.get("mode") != "unchanged":
+        pipe.lpush(_durations_key(), report["seconds"])
+        pipe.ltrim(_durations_key(), 0, DURATION_HISTORY_LENGTH - 1)
+    pipe.execute()
+
+
+def failed(resource_id, error, report=None):
+    # marks a build as failed - the stage it failed in is left as it was
+    key = _status_key(resource_id)
+    pipe = connect_to_redis().pipeline()
+    pipe.hset(key, "state", "failed")
+    pipe.hset(key, "finished", _now())
+    pipe.hset(key, "error", error)
+    if report is not None:
+        pipe.hset(key, "seconds", report["seconds"])
+        pipe.hset(key, "report", json.dumps(report))
+    pipe.expire(key, _ttl())
+    pipe.execute()
+
+
+def _age(enqueued_at):
+    # rq keeps its dates in naive UTC
+    if enqueued_at is None:
+        return None
+    return round((datetime.utcnow() - enqueued_at).total_seconds(), 3)
+
+
+def show(resource_id):
+    """Returns where a resource's cache build is at
+
+    status is "queued", "running", "finished", "failed", or None if we
+    dont know of any build. A resource can be running and have its next
+    build queued at the same time - "queued" then has that next job
+    """
+
+    redis_conn = connect_to_redis()
+    queue = jobs.get_queue(queue_name())
+
+    build = {
+        k.decode("utf-8"): v.decode("utf-8")
+        for k, v in redis_conn.hgetall(_status_key(resource_id)).items()
+    }
+    if "seconds" in build:
+        build["seconds"] = float(build["seconds"])
+    if "report" in build:
+        build["report"] = json.loads(build["report"])
+
+    # a worker that was killed mid build never gets to mark it failed, so
+    # check with the job queue
+    if build.get("state") == "running" and build.get("job_id"):
+        job = queue.fetch_job(build["job_id"])
+        if job is None or job.get_status() == "failed":
+            build["state"] = "failed"
+            build.setdefault("error", "Job {} is gone or failed".format(build["job_id"]))
+
+    queued = None
+    is_waiting, job = waiting_job(resource_id, queue)
+    if is_waiting and job is not None:
+        queued = {
+            "job_id": job.id,
+            "enqueued_at": job.enqueued_at.strftime("%Y-%m-%dT%H:%M:%S.%f")
+            if job.enqueued_at
+            else None,
+            "waiting_seconds": _age(job.enqueued_at),
+        }
+
+    state = build.pop("state", None)
+    return dict(
+        build,
+        resource_id=resource_id,
+        status="queued" if queued and state != "running" else state,
+        queued=queued,
+    )
+
+
+def durations():
+    """Returns how long the latest builds took: how many we looked at, and
+    their average, median and longest seconds"""
+
+    seconds = sorted(
+        float(value)
+        for value in connect_to_redis().lrange(
+            _durations_key(), 0, DURATION_HISTORY_LENGTH - 1
+        )
+    )
+    if not seconds:
+        return {"jobs": 0, "average": None, "median": None, "max": None}
+
+    return {
+        "jobs": len(seconds),
+        "average": round(sum(seconds) / len(seconds), 3),
+        "median": seconds[len(seconds) // 2],
+        "max": seconds[-1],
+    }
+
+
+def queue_status():
+    """Returns how many datastore_cache jobs are waiting and running, how
+    long the oldest one has waited, and the time per job"""
+
+    queue = jobs.get_queue(queue_name())
+
+    waiting = [
+        job_id for job_id in queue.get_job_ids() if job_id.startswith(JOB_ID_PREFIX)
+    ]
+    running = [
+        job_id
+        for job_id in StartedJobRegistry(queue=queue).get_job_ids()
+        if job_id.startswith(JOB_ID_PREFIX)
+    ]
+
+    # the queue is first in first out, so the first of ours is the oldest
+    oldest = queue.fetch_job(waiting[0]) if waiting else None
+
+    return {
+        "queue": queue_name(),
+        "queue_depth": queue.count,
+        "queued": len(waiting),
+        "running": len(running),
+        "oldest_job_id": oldest.id if oldest else None,
+        "oldest_job_age": _age(oldest.enqueued_at) if oldest else None,
+        "time_per_job": durations(),
+    }
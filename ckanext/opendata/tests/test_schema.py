@@ -0,0 +1,99 @@
+"""Checks schema.update_package saves a package's formats and last_refreshed
+the way the package_patch it replaced did"""
+
+from ckanext.opendata import schema, utils
+from datetime import datetime
+from unittest import mock
+
+import types
+import unittest
+
+# the validators the package schema runs on these fields
+FIELD_VALIDATORS = {
+    "formats": utils.choices_to_string,
+    "last_refreshed": utils.default_to_today,
+}
+
+RESOURCES = [
+    {"format": "csv", "created": datetime(2020, 1, 1), "last_modified": None},
+    {
+        "format": "JSON",
+        "created": datetime(2020, 1, 1),
+        "last_modified": datetime(2021, 6, 30, 12, 0, 0, 123400),
+    },
+    {"format": "Csv", "created": datetime(2021, 1, 1), "last_modified": None},
+]
+
+
+def plugin_validate(package_plugin, context, data_dict, package_schema, action):
+    # like the scheming schema: our fields are validated and saved as extras
+    extras = [
+        {"key": key, "value": validator(data_dict[key])}
+        for key, validator in FIELD_VALIDATORS.items()
+        if key in data_dict
+    ]
+    return {"extras": extras}, {"title": ["Missing value"]}
+
+
+def old_update_package(resources):
+    """What the package_patch in the old update_package saved"""
+
+    formats = ",".join(sorted({r["format"].upper() for r in resources}))
+    last_refreshed = max(
+        r["created"] if r["last_modified"] is None else r["last_modified"]
+        for r in resources
+    ).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+    return {
+        key: FIELD_VALIDATORS[key](value)
+        for key, value in {"formats": formats, "last_refreshed": last_refreshed}.items()
+    }
+
+
+class TestUpdatePackage(unittest.TestCase):
+    def setUp(self):
+        self.package = types.SimpleNamespace(
+            id="package-id", name="package", type="dataset", extras={},
+            metadata_modified=None,
+        )
+
+        query = mock.MagicMock()
+        query.filter.return_value = query
+        query.one.return_value = (
+            list({r["format"].upper() for r in RESOURCES}),
+            max(r["last_modified"] or r["created"] for r in RESOURCES),
+        )
+
+        patches = [
+            mock.patch.object(
+                schema.model, "Session", mock.MagicMock(**{"query.return_value": query})
+            ),
+            mock.patch.object(schema.model, "repo", mock.MagicMock()),
+            mock.patch.object(
+                schema.lib_plugins, "lookup_package_plugin", mock.MagicMock()
+            ),
+            mock.patch.object(schema.lib_plugins, "plugin_validate", plugin_validate),
+            mock.patch.object(schema.cache, "invalidate_package", mock.MagicMock()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_saves_what_package_patch_did(self):
+        schema.update_package({"package": self.package})
+
+        self.assertEqual(self.package.extras, old_update_package(RESOURCES))
+        schema.model.repo.commit.assert_called_once_with()
+
+    def test_saved_values_are_not_a_change(self):
+        schema.update_package({"package": self.package})
+        # extras come back from the database as text
+        self.package.extras = {
+            "formats": self.package.extras["formats"],
+            "last_refreshed": str(self.package.extras["last_refreshed"]),
+        }
+        schema.model.repo.commit.reset_mock()
+
+        schema.update_package({"package": self.package})
+
+        schema.model.repo.commit.assert_not_called()
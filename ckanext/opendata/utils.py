@@ -1,7 +1,14 @@
 from datetime import datetime
+from decimal import Decimal
+from ckan.lib.redis import connect_to_redis
 import ckan.plugins.toolkit as tk
+from ckanext.datastore.backend.postgres import get_read_engine, identifier
+import sqlalchemy as sa
+
+from . import cache
+
+import hashlib
 import json
-import csv
 import re
 import codecs
 
@@ -14,10 +21,252 @@ def hex_to_string(s):
     return codecs.decode(s, "hex").decode("utf-8")
 
 
-def is_geospatial(resource_id):
-    info = tk.get_action("datastore_info")(None, {"id": resource_id})
+def redis_key(*parts):
+    # namespaces the keys this extension writes to redis, so they dont clash
+    # with core CKAN or other CKAN instances sharing the same redis
+    return ":".join(
+        ["ckanext-opendata", tk.config.get("ckan.site_id", "default")]
+        + [str(part) for part in parts]
+    )
+
+
+def _datastore_schema_key(resource_id):
+    return redis_key("datastore_schema", resource_id)
+
+
+def _store_datastore_schema(resource_id, context=None):
+    # reads a datastore table's columns and shares them with every worker
+    cache.invalidate_resource(context, resource_id)
+    info = cache.cached_action(context, "datastore_info", {"id": resource_id})
+    schema = {
+        "fields": [
+            {"id": name, "type": field_type}
+            for name, field_type in info["schema"].items()
+        ],
+        "geospatial": "geometry" in info["schema"],
+    }
+
+    connect_to_redis().set(
+        _datastore_schema_key(resource_id),
+        json.dumps(schema),
+        ex=tk.asint(tk.config.get("ckanext.opendata.datastore_schema_ttl", 86400)),
+    )
+    return schema
+
+
+def datastore_schema(resource_id, context=None):
+    """Returns the columns of a datastore table, as {"fields": [{"id", "type"}],
+    "geospatial": True if it has a geometry column}
+
+    Schemas are kept in redis for every worker to use. datastore_create
+    refreshes them when it changes a table's columns, and datastore_delete
+    drops them with the table
+    """
+
+    cached = connect_to_redis().get(_datastore_schema_key(resource_id))
+    if cached is not None:
+        return json.loads(cached)
+
+    return _store_datastore_schema(resource_id, context)
+
+
+def refresh_datastore_schema(resource_id, data_dict, context=None):
+    """Keeps the shared schema of a datastore table in step after a
+    datastore_create call on it
+
+    Most calls just add records to known columns, so we only go back to
+    the datastore when the call names a column we dont know, or gives a
+    known column a type other than the one we have for it
+    """
+
+    cached = connect_to_redis().get(_datastore_schema_key(resource_id))
+    if cached is not None:
+        known = {field["id"]: field["type"] for field in json.loads(cached)["fields"]}
+        incoming = set()
+        for field in data_dict.get("fields") or []:
+            incoming.add(field["id"])
+            # fields without a type keep the one they have
+            if field.get("type") and known.get(field["id"]) != field["type"]:
+                return _store_datastore_schema(resource_id, context)
+        for record in data_dict.get("records") or []:
+            incoming.update(record.keys())
+
+        if incoming <= set(known):
+            return json.loads(cached)
+
+    return _store_datastore_schema(resource_id, context)
+
+
+def invalidate_datastore_schema(resource_id):
+    # drops the shared schema of a datastore table, after the table is dropped
+    connect_to_redis().delete(_datastore_schema_key(resource_id))
+
+
+def _datastore_modified_key(resource_id):
+    return redis_key("datastore_modified", resource_id)
+
+
+def touch_datastore(resource_id):
+    # remembers when a datastore table's records last changed
+    connect_to_redis().set(
+        _datastore_modified_key(resource_id),
+        datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f"),
+    )
+
+
+def datastore_last_modified(resource_id):
+    """Returns when a datastore table's records last changed, as a datetime,
+    or None if they havent changed since we started keeping track"""
+
+    value = connect_to_redis().get(_datastore_modified_key(resource_id))
+    return str_to_datetime(value.decode("utf-8")) if value else None
+
+
+def is_geospatial(resource_id, context=None):
+    return datastore_schema(resource_id, context)["geospatial"]
+
+
+def _columns_hash(connection, resource_id):
+    # a hash of a datastore table's column names and types
+    columns = connection.execute(
+        sa.text(
+            """
+            SELECT string_agg(column_name || ':' || data_type, ','
+                ORDER BY ordinal_position)
+            FROM information_schema.columns
+            WHERE table_name = :resource_id
+            """
+        ),
+        resource_id=resource_id,
+    ).scalar()
+    return hashlib.md5((columns or "").encode("utf-8")).hexdigest()
 
-    return "geometry" in info["schema"]
+
+def datastore_cache_started(resource):
+    """Returns when the last datastore_cache run of a resource started, as a
+    datetime, or None if it was never cached"""
+
+    report = to_dict(resource.get("datastore_cache_report")) or {}
+    started = report.get("started") or resource.get("datastore_cache_last_update")
+    return str_to_datetime(started) if started else None
+
+
+def datastore_unchanged_since(resource_id, previous_state, since):
+    """True if a datastore table surely hasnt changed since a previous
+    datastore_content_state, taken at since
+
+    This is the cheap check datastore_cache makes before hashing every row:
+    no datastore_create / upsert / delete since then (see touch_datastore),
+    and the same row count, highest _id and columns. If we cant tell, it's
+    False, and the rows have to be hashed
+    """
+
+    if previous_state is None or since is None:
+        return False
+
+    modified = datastore_last_modified(resource_id)
+    if modified is None or modified > since:
+        return False
+
+    engine = get_read_engine()
+    with engine.connect() as connection:
+        state = connection.execute(
+            sa.text(
+                "SELECT count(*) AS rows, coalesce(max(_id), 0) AS max_id FROM {}".format(
+                    identifier(resource_id)
+                )
+            )
+        ).fetchone()
+        columns = _columns_hash(connection, resource_id)
+
+    return (
+        int(state["rows"]) == previous_state.get("rows")
+        and int(state["max_id"]) == previous_state.get("max_id")
+        and columns == previous_state.get("columns")
+    )
+
+
+def datastore_content_state(resource_id, up_to_id=None):
+    """Describes a datastore table's content, so we can tell if it changed
+
+    Returns the row count, the highest _id, a hash of the table's columns,
+    and a hash of every row. Row hashes are summed, so row order doesnt
+    matter, and _id / _full_text are left out, so reloading the same records
+    into a truncated table gives the same hash.
+
+    If up_to_id is given, the count and hash of only the rows with
+    _id <= up_to_id are returned too, so we can tell if a table was only
+    appended to since a previous state
+    """
+
+    engine = get_read_engine()
+    with engine.connect() as connection:
+        state = connection.execute(
+            sa.text(
+                """
+                SELECT count(*) AS rows,
+                    coalesce(max(_id), 0) AS max_id,
+                    coalesce(sum(row_hash), 0) AS rows_hash,
+                    count(*) FILTER (WHERE _id <= :up_to_id) AS prefix_rows,
+                    coalesce(sum(row_hash) FILTER (WHERE _id <= :up_to_id), 0)
+                        AS prefix_hash
+                FROM (
+                    SELECT _id, ('x' || substr(md5(
+                        (to_jsonb(t) - '_id' - '_full_text')::text
+                    ), 1, 15))::bit(60)::bigint AS row_hash
+                    FROM {table} t
+                ) row_hashes
+                """.format(table=identifier(resource_id))
+            ),
+            up_to_id=up_to_id or 0,
+        ).fetchone()
+        columns = _columns_hash(connection, resource_id)
+
+    output = {
+        "rows": int(state["rows"]),
+        "max_id": int(state["max_id"]),
+        "rows_hash": str(state["rows_hash"]),
+        "columns": columns,
+    }
+    if up_to_id is not None:
+        output["prefix_rows"] = int(state["prefix_rows"])
+        output["prefix_hash"] = str(state["prefix_hash"])
+
+    return output
+
+
+def datastore_fingerprint(state):
+    """Turns a datastore_content_state into a short fingerprint string"""
+
+    content_hash = hashlib.md5(
+        "{}|{}".format(state["rows_hash"], state["columns"]).encode("utf-8")
+    ).hexdigest()
+
+    return "{}:{}".format(state["rows"], content_hash)
+
+
+def is_append_only(previous_state, state):
+    """True if the only change between two content states is new rows
+    at the end of the table"""
+
+    return (
+        previous_state is not None
+        and "prefix_rows" in state.keys()
+        and state["columns"] == previous_state["columns"]
+        and state["prefix_rows"] == previous_state["rows"]
+        and state["prefix_hash"] == previous_state["rows_hash"]
+        and state["rows"] > previous_state["rows"]
+    )
+
+
+def to_dict(value):
+    # dict values saved on resources can come back to us as strings
+    if isinstance(value, str):
+        try:
+            value = json.loads(value.replace("'", '"'))
+        except ValueError:
+            return None
+    return value if isinstance(value, dict) else None
 
 
 def to_list(input):
@@ -45,9 +294,7 @@ def unstringify(input):
     # ... (it will hold arrays that solr turned into a string) ...
     # outputs a dict for use in /search_facet
 
-    names = []
-    terms = []
-    output = []
+    counts = {}
 
     assert isinstance(input, list), "Input to unstringify is not a list, its {}".format(
         type(input)
@@ -71,20 +318,15 @@ def unstringify(input):
                 .replace('"', "")
                 .split(",")
             )
-            names += these_names
-            terms.append({"names": these_names, "count": item["count"]})
-
-    # get the distinct terms and make an output dict structure for them
-    for name in set(names):
-        item = {"count": 0, "display_name": name, "name": name}
-        # update the count attribute in the appropriate dict in the output dict
-        for value in terms:
-            if name in value["names"]:
-                item["count"] += value["count"]
+            # add this item's count to each distinct name in it
+            for name in set(these_names):
+                counts[name] = counts.get(name, 0) + item["count"]
 
-        output.append(item)
-
-    return output
+    # make an output dict structure for the distinct terms
+    return [
+        {"count": count, "display_name": name, "name": name}
+        for name, count in counts.items()
+    ]
 
 
 # Useful scheming validator functions
@@ -139,32 +381,6 @@ def default_to_today(value):
         return datetime.today()
 
 
-def datastore_to_csv(resource_id, data, filepath):
-    # In ckan <2.9.3, the lazyjson object only works as a normal dict
-    # when you take its 0th index
-
-    with open(
-        "/usr/lib/ckan/default/src/ckanext-opendatatoronto/ckanext/opendata/"
-        + resource_id
-        + ".csv",
-        "w",
-    ) as file:
-        writer = csv.writer(file)
-        headers = data[0].keys()
-        writer.writerow(headers)
-        for row in data:
-            assert row.keys() == headers
-            writer.writerow(row.values())
-    file.close()
-
-
-def lazyjson_to_dict(lazyjson):
-    output = []
-    for item in lazyjson:
-        output.append(item)
-    return output
-
-
 def str_to_datetime(input):
     # loops through the list of formats and tries to return an input
     # string into a datetime of one of those formats
@@ -203,16 +419,114 @@ def list_to_words(input):
         return output
 
 
+# n-gram copies of fields are indexed under this prefix, which matches the
+# multivalued vocab_* dynamic field in CKAN's solr schema
+NGRAM_FIELD_PREFIX = "vocab_ngram_"
+
+
+def ngram_search_enabled():
+    # whether build_query uses the n-gram fields instead of wildcards
+    # turn this on only after the search index has been rebuilt with them
+    return tk.asbool(tk.config.get("ckanext.opendata.ngram_search", False))
+
+
+def ngram_fields():
+    # fields we index n-gram copies of
+    return tk.aslist(
+        tk.config.get(
+            "ckanext.opendata.ngram_fields",
+            "name title tags topics civic_issues formats owner_division "
+            "dataset_category refresh_rate",
+        )
+    )
+
+
+def ngram_max_length():
+    # longest n-gram we index - longer search terms fall back to wildcards
+    return tk.asint(tk.config.get("ckanext.opendata.ngram_max_length", 20))
+
+
+def ngrams(value, max_length):
+    # every substring of value, up to max_length characters long
+    output = set()
+    for start in range(len(value)):
+        for end in range(start + 1, min(len(value), start + max_length) + 1):
+            output.add(value[start:end])
+    return output
+
+
+def add_ngram_fields(pkg_dict):
+    """Adds n-gram copies of ngram_fields() to a package about to be indexed
+
+    A term query for "x" on a copy matches the same packages as the wildcard
+    query *x* on the original field. Most fields are solr strings, which
+    wildcards match as a whole, so we take n-grams of the whole value.
+    title is a solr text field, which wildcards match word by word in lower
+    case, so we take n-grams of each of its lowercased words
+    """
+
+    max_length = ngram_max_length()
+
+    for field in ngram_fields():
+        values = pkg_dict.get(field)
+        if not values:
+            continue
+        if not isinstance(values, list):
+            values = [values]
+        values = [value for value in values if isinstance(value, str)]
+
+        if field == "title":
+            values = [
+                word
+                for value in values
+                for word in re.split(r"[\W_]+", value.lower())
+                if word
+            ]
+
+        output = set()
+        for value in values:
+            output.update(ngrams(value, max_length))
+        pkg_dict[NGRAM_FIELD_PREFIX + field] = sorted(output)
+
+    return pkg_dict
+
+
+def solr_phrase(term):
+    # quotes a term for a solr query
+    return '"{}"'.format(term.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+# the package with the ETL inventory shown on the homepage
+CATALOG_PACKAGE = "od-etl-configs"
+
+
+def _fetch_catalog():
+    package = tk.get_action("package_show")(data_dict={"id": CATALOG_PACKAGE})
+    resource_id = package["resources"][0]["id"]
+
+    # remember which resource the catalog comes from, so loads into it can
+    # invalidate the cached copy
+    connect_to_redis().set(redis_key("catalog", "resource_id"), resource_id)
+
+    output = tk.get_action("datastore_search")(
+        data_dict={"resource_id": resource_id, "limit": 32000}
+    )
+    output["url"] = package["resources"][0]["url"]
+    return output
+
+
 def get_catalog():
     """gets catalog datastore resource as json object"""
 
     try:
-        package = tk.get_action("package_show")(data_dict={"id": "od-etl-configs"})
-        resource_id = package["resources"][0]["id"]
-        output = tk.get_action("datastore_search")(
-            data_dict={"resource_id": resource_id, "limit": 32000}
+        # the catalog isnt public, so check this user can see it before
+        # handing them the cached copy
+        tk.check_access("package_show", {"user": tk.c.user}, {"id": CATALOG_PACKAGE})
+        output = cache.get_or_set(
+            "catalog",
+            _fetch_catalog,
+            tk.asint(tk.config.get("ckanext.opendata.catalog_cache_ttl", 300)),
         )
-        output["url"] = package["resources"][0]["url"]
     except Exception as e:
         print("Couldnt access catalog page:\n" + str(e))
         output = {
@@ -226,6 +540,67 @@ def get_catalog():
     return output
 
 
+def invalidate_catalog(resource_id):
+    # drops the cached catalog if resource_id is the catalog's resource
+    catalog_resource_id = connect_to_redis().get(redis_key("catalog", "resource_id"))
+    if catalog_resource_id and catalog_resource_id.decode("utf-8") == resource_id:
+        cache.invalidate("catalog")
+
+
+# the package whose lookup tables feed the owner division, refresh rate and
+# dataset category choices of every package
+METADATA_CATALOG_PACKAGE = "metadata-catalog"
+
+# metadata-catalog resources we protect from bulk deletes
+PROTECTED_LOOKUPS = ["Owner Division", "Refresh Rate", "Dataset Category"]
+
+
+def _fetch_protected_lookups():
+    # finds the protected metadata-catalog resources and the values
+    # metadata-catalog itself uses, which mustnt be deleted from them
+    try:
+        package = tk.get_action("package_show")(
+            {"ignore_auth": True}, {"id": METADATA_CATALOG_PACKAGE}
+        )
+    except tk.ObjectNotFound:
+        return {"resources": {}, "values": []}
+
+    return {
+        "resources": {
+            r["id"]: r["name"]
+            for r in package["resources"]
+            if r["datastore_active"] in [True, "True", "true"]
+            and r["name"] in PROTECTED_LOOKUPS
+        },
+        "values": [
+            package.get("owner_division"),
+            package.get("refresh_rate"),
+            package.get("dataset_category"),
+        ],
+    }
+
+
+def protected_lookups():
+    """Returns the protected metadata-catalog resources, as {id: name}, and
+    the values that mustnt be deleted from them
+
+    This is checked on every datastore_delete, so it's cached until
+    metadata-catalog changes
+    """
+
+    return cache.get_or_set(
+        "protected_lookups",
+        _fetch_protected_lookups,
+        tk.asint(tk.config.get("ckanext.opendata.metadata_catalog_cache_ttl", 3600)),
+    )
+
+
+def invalidate_protected_lookups(package_name):
+    # drops the cached protected lookups if package_name is metadata-catalog
+    if package_name == METADATA_CATALOG_PACKAGE:
+        cache.invalidate("protected_lookups")
+
+
 def parse_dqs_codes(input):
     '''takes a tilde (~) separated string containing dqs codes
     and parses it into meaningful descriptions in an array'''
@@ -305,6 +680,194 @@ def parse_dqs_codes(input):
     return output
 
 
+# DQS scores are loaded into this resource of this package
+DQS_PACKAGE = "catalogue-quality-scores"
+DQS_RESOURCE = "quality-scores-explanation-codes-and-scores"
+
+# numeric columns of a DQS record
+DQS_SCORE_FIELDS = ["score", "freshness", "metadata", "accessibility", "completeness", "usability"]
+
+
+def _add_to_dqs_entry(entry, record):
+    # folds one DQS record into a package's index entry, which keeps only the
+    # latest records of each resource, and whether any of that resource's
+    # records were for the datastore
+    recorded_at = str_to_datetime(str(record.get("recorded_at")))
+    if recorded_at is None or not record.get("resource"):
+        return
+
+    # records coming straight from a load can have strings where
+    # datastore_search would give us numbers
+    record = dict(record, recorded_at=recorded_at.strftime("%Y-%m-%dT%H:%M:%S"))
+    for field in DQS_SCORE_FIELDS:
+        if record.get(field) not in [None, ""]:
+            record[field] = float(record[field])
+
+    current = entry.get(record["resource"])
+    if current is None or record["recorded_at"] > current["recorded_at"]:
+        entry[record["resource"]] = {
+            "recorded_at": record["recorded_at"],
+            "records": [record],
+            "datastore": current["datastore"] if current else False,
+        }
+    elif record["recorded_at"] == current["recorded_at"]:
+        current["records"].append(record)
+
+    if record.get("store_type") == "datastore":
+        entry[record["resource"]]["datastore"] = True
+
+
+# field of a package's index hash that says the package has been indexed,
+# even if none of its resources have scores
+DQS_INDEXED_FIELD = "__indexed__"
+
+
+def _dqs_index_key(package_name):
+    return redis_key("dqs", "index", package_name)
+
+
+def _dqs_packages_key():
+    # the names of the packages in the index, so it can be cleared
+    return redis_key("dqs", "packages")
+
+
+def _dqs_index_ttl():
+    return tk.asint(tk.config.get("ckanext.opendata.dqs_index_ttl", 86400))
+
+
+def is_dqs_resource(resource_id):
+    # true if resource_id is the resource DQS scores are loaded into
+    dqs_resource_id = connect_to_redis().get(redis_key("dqs", "resource_id"))
+    return bool(dqs_resource_id) and dqs_resource_id.decode("utf-8") == resource_id
+
+
+def dqs_entry(package_name, resource_name):
+    """Returns the latest DQS records of one resource of a package, or None
+
+    Each package is a hash in redis, with a field per resource, so this
+    reads just the one resource's records. Packages are indexed from
+    quality_show the first time they're asked for, and kept up to date by
+    update_dqs_index as new scores are loaded
+    """
+
+    redis_conn = connect_to_redis()
+    key = _dqs_index_key(package_name)
+    indexed, entry = redis_conn.hmget(key, [DQS_INDEXED_FIELD, resource_name])
+    if indexed is not None:
+        return json.loads(entry) if entry is not None else None
+
+    entry = {}
+    for record in tk.get_action("quality_show")(data_dict={"package_id": package_name}) or []:
+        _add_to_dqs_entry(entry, record)
+
+    pipe = redis_conn.pipeline()
+    pipe.hset(key, DQS_INDEXED_FIELD, 1)
+    for name, resource_entry in entry.items():
+        pipe.hset(key, name, json.dumps(resource_entry))
+    pipe.expire(key, _dqs_index_ttl())
+    pipe.sadd(_dqs_packages_key(), package_name)
+    pipe.execute()
+
+    return entry.get(resource_name)
+
+
+def update_dqs_index(records):
+    """Adds newly loaded DQS records to the packages already in the index
+    Packages that arent indexed yet will be, the first time they're asked for"""
+
+    records_by_package = {}
+    for record in records:
+        if record.get("package") and record.get("resource"):
+            records_by_package.setdefault(record["package"], []).append(record)
+    if not records_by_package:
+        return
+
+    keys = {name: _dqs_index_key(name) for name in records_by_package.keys()}
+
+    def update(pipe):
+        # only the resources these records are about are read and written
+        changes = {}
+        for package_name, package_records in records_by_package.items():
+            resource_names = sorted({record["resource"] for record in package_records})
+            values = pipe.hmget(keys[package_name], [DQS_INDEXED_FIELD] + resource_names)
+            if values[0] is None:
+                continue
+
+            entry = {
+                name: json.loads(value)
+                for name, value in zip(resource_names, values[1:])
+                if value is not None
+            }
+            for record in package_records:
+                _add_to_dqs_entry(entry, record)
+            changes[package_name] = entry
+
+        pipe.multi()
+        for package_name, entry in changes.items():
+            for name, resource_entry in entry.items():
+                pipe.hset(keys[package_name], name, json.dumps(resource_entry))
+            pipe.expire(keys[package_name], _dqs_index_ttl())
+
+    # retries if another load changes these packages while we're updating them
+    connect_to_redis().transaction(update, *keys.values())
+
+
+def latest_dqs_records(resource_id, package_names=None, limit=10000, offset=0):
+    """Returns the latest DQS records of each resource of the input packages
+    (or of every package) from one query, sorted by package and resource"""
+
+    where = "WHERE package = ANY(:package_names)" if package_names else ""
+    params = {"limit": limit, "offset": offset}
+    if package_names:
+        params["package_names"] = list(package_names)
+
+    engine = get_read_engine()
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            sa.text(
+                """
+                SELECT * FROM (
+                    SELECT t.*, rank() OVER (
+                        PARTITION BY package, resource ORDER BY recorded_at DESC
+                    ) AS latest_rank
+                    FROM {table} t
+                    {where}
+                ) scores
+                WHERE latest_rank = 1
+                ORDER BY package, resource, _id
+                LIMIT :limit OFFSET :offset
+                """.format(table=identifier(resource_id), where=where)
+            ),
+            **params
+        )
+        keys = [k for k in result.keys() if k not in ["_full_text", "latest_rank"]]
+
+        # match the types datastore_search would give us
+        return [
+            {
+                key: (
+                    row[key].isoformat()
+                    if isinstance(row[key], datetime)
+                    else float(row[key])
+                    if isinstance(row[key], Decimal)
+                    else row[key]
+                )
+                for key in keys
+            }
+            for row in result
+        ]
+
+
+def clear_dqs_index():
+    redis_conn = connect_to_redis()
+    package_names = [
+        name.decode("utf-8") for name in redis_conn.smembers(_dqs_packages_key())
+    ]
+    redis_conn.delete(
+        _dqs_packages_key(), *[_dqs_index_key(name) for name in package_names]
+    )
+
+
 def get_dqs(input_package, input_resource):
 
     # initialize descriptions for output
@@ -338,22 +901,16 @@ def get_dqs(input_package, input_resource):
                       ]},
     }
 
-    # get DQS values from CKAN for this package    
-    datastore_resources = tk.get_action("quality_show")(data_dict={"package_id": input_package["name"]})
-
-    # if there's no DQS for this package, return empty list
-    if len(datastore_resources) == 0:
-         return [] 
-	    
-    datastore_resource = [r for r in datastore_resources if r["resource"] == input_resource["name"]]
+    # get latest DQS values for this package's resource from the index
+    datastore_resource = dqs_entry(input_package["name"], input_resource["name"])
 
     # if there's no DQS for this resource, return empty list
-    if len(datastore_resource) == 0:
+    if not datastore_resource:
          return [] 
     
     # parse DQS values
-    max_date = max(datetime.strptime(x["recorded_at"], "%Y-%m-%dT%H:%M:%S") for x in datastore_resource)
-    records = [r for r in datastore_resource if r["recorded_at"] == max_date.strftime("%Y-%m-%dT%H:%M:%S")]
+    max_date = datetime.strptime(datastore_resource["recorded_at"], "%Y-%m-%dT%H:%M:%S")
+    records = datastore_resource["records"]
     
     # init output with overall scores
     output = {
@@ -368,7 +925,7 @@ def get_dqs(input_package, input_resource):
     # populate output with dimension-specific scores
     # filestore resources only get 3 dimensions, datastore get all 5
 
-    store_type = "datastore" if any([r for r in datastore_resource if r["store_type"]=="datastore"]) else "filestore"
+    store_type = "datastore" if datastore_resource["datastore"] else "filestore"
     dimensions = ["freshness", "metadata", "accessibility"]
     if store_type == "datastore":
         dimensions += ["completeness","usability"]